@@ -4,123 +4,143 @@ Created on 15.12.2014
 @author: Peter U. Diehl
 '''
 
-import scipy.ndimage as sp
+import argparse
 import numpy as np
-import pylab
+
+from functions.connections import WEIGHTS_EXT, WeightsWriter
+
+# number of matrix entries generated and written at a time
+chunkSize = 1 << 22
 
 
 def randomDelay(minDelay, maxDelay):
     return np.random.rand()*(maxDelay-minDelay) + minDelay
-        
-        
+
+
 def computePopVector(popArray):
     size = len(popArray)
-    complex_unit_roots = np.array([np.exp(1j*(2*np.pi/size)*cur_pos) for cur_pos in xrange(size)])
+    complex_unit_roots = np.exp(1j*(2*np.pi/size)*np.arange(size))
     cur_pos = (np.angle(np.sum(popArray * complex_unit_roots)) % (2*np.pi)) / (2*np.pi)
     return cur_pos
 
-        
-def sparsenMatrix(baseMatrix, pConn):
-    weightMatrix = np.zeros(baseMatrix.shape)
-    numWeights = 0
-    numTargetWeights = baseMatrix.shape[0] * baseMatrix.shape[1] * pConn
-    weightList = [0]*int(numTargetWeights)
-    while numWeights < numTargetWeights:
-        idx = (np.int32(np.random.rand()*baseMatrix.shape[0]), np.int32(np.random.rand()*baseMatrix.shape[1]))
-        if not (weightMatrix[idx]):
-            weightMatrix[idx] = baseMatrix[idx]
-            weightList[numWeights] = (idx[0], idx[1], baseMatrix[idx])
-            numWeights += 1
-    return weightMatrix, weightList
-        
-    
-def create_weights():
-    
+
+def denseChunks(nSrc, nTgt, getRows):
+    # all nSrc x nTgt weights, a block of rows at a time; getRows(start, stop)
+    # returns the weights of rows start:stop
+    rowsPerChunk = max(1, chunkSize // nTgt)
+    for start in range(0, nSrc, rowsPerChunk):
+        yield getRows(start, min(start + rowsPerChunk, nSrc))
+
+
+def sparseChunks(nSrc, nTgt, pConn, weight, rng, offset=0.):
+    # int(nSrc*nTgt*pConn) distinct entries drawn uniformly without
+    # replacement, with weights (uniform(0, 1) + offset) * weight. The number
+    # of entries in each block of rows follows the multivariate
+    # hypergeometric distribution, so sampling block by block is exact.
+    numTargetWeights = int(nSrc * nTgt * pConn)
+    rowsPerChunk = max(1, chunkSize // nTgt)
+    starts = np.arange(0, nSrc, rowsPerChunk)
+    blockSizes = (np.minimum(starts + rowsPerChunk, nSrc) - starts) * nTgt
+    counts = rng.multivariate_hypergeometric(blockSizes, numTargetWeights)
+    for start, blockSize, count in zip(starts, blockSizes, counts):
+        flat = np.sort(rng.choice(blockSize, count, replace=False))
+        i, j = np.divmod(flat, nTgt)
+        yield start + i, j, (rng.random(count) + offset) * weight
+
+
+def saveConnections(fileName, shape, chunks, numEntries=None):
+    # stream the chunks into a weight file: blocks of rows if numEntries is
+    # None (dense layout), otherwise (i, j, w) chunks
+    writer = WeightsWriter(fileName, shape, numEntries)
+    for chunk in chunks:
+        if numEntries is None:
+            writer.write_rows(chunk)
+        else:
+            writer.write(*chunk)
+    writer.close()
+
+
+def create_weights(nE=400, dataPath='./random/', seed=None):
+
     nInput = 784
-    nE = 400
-    nI = nE 
-    dataPath = './random/'
+    nI = nE
+    rng = np.random.default_rng(seed)
     weight = {}
-    weight['ee_input'] = 0.3 
-    weight['ei_input'] = 0.2 
+    weight['ee_input'] = 0.3
+    weight['ei_input'] = 0.2
     weight['ee'] = 0.1
     weight['ei'] = 10.4
     weight['ie'] = 17.0
     weight['ii'] = 0.4
     pConn = {}
-    pConn['ee_input'] = 1.0 
-    pConn['ei_input'] = 0.1 
+    pConn['ee_input'] = 1.0
+    pConn['ei_input'] = 0.1
     pConn['ee'] = 1.0
     pConn['ei'] = 0.0025
     pConn['ie'] = 0.9
     pConn['ii'] = 0.1
-    
-    
-    print 'create random connection matrices'
+
+
+    print('create random connection matrices')
     connNameList = ['XeAe']
     for name in connNameList:
-        weightMatrix = np.random.random((nInput, nE)) + 0.01
-        weightMatrix *= weight['ee_input']
         if pConn['ee_input'] < 1.0:
-            weightMatrix, weightList = sparsenMatrix(weightMatrix, pConn['ee_input'])
+            numEntries = int(nInput * nE * pConn['ee_input'])
+            chunks = sparseChunks(nInput, nE, pConn['ee_input'], weight['ee_input'], rng, offset=0.01)
         else:
-            weightList = [(i, j, weightMatrix[i,j]) for j in xrange(nE) for i in xrange(nInput)]
-        np.save(dataPath+name, weightList)
-    
-    
-    
-    print 'create connection matrices from E->I which are purely random'
+            numEntries = None
+            chunks = denseChunks(nInput, nE, lambda start, stop:
+                                 (rng.random((stop - start, nE)) + 0.01) * weight['ee_input'])
+        saveConnections(dataPath+name+WEIGHTS_EXT, (nInput, nE), chunks, numEntries)
+
+
+
+    print('create connection matrices from E->I which are purely random')
     connNameList = ['XeAi']
     for name in connNameList:
-        weightMatrix = np.random.random((nInput, nI))
-        weightMatrix *= weight['ei_input']
-        weightMatrix, weightList = sparsenMatrix(weightMatrix, pConn['ei_input'])
-        print 'save connection matrix', name
-        np.save(dataPath+name, weightList)
-        
-    
-    
-    print 'create connection matrices from E->I which are purely random'
+        numEntries = int(nInput * nI * pConn['ei_input'])
+        chunks = sparseChunks(nInput, nI, pConn['ei_input'], weight['ei_input'], rng)
+        print('save connection matrix', name)
+        saveConnections(dataPath+name+WEIGHTS_EXT, (nInput, nI), chunks, numEntries)
+
+
+
+    print('create connection matrices from E->I which are purely random')
     connNameList = ['AeAi']
     for name in connNameList:
         if nE == nI:
-            weightList = [(i, i, weight['ei']) for i in xrange(nE)]
+            numEntries = nE
+            chunks = [(np.arange(nE), np.arange(nE), np.full(nE, weight['ei']))]
         else:
-            weightMatrix = np.random.random((nE, nI))
-            weightMatrix *= weight['ei']
-            weightMatrix, weightList = sparsenMatrix(weightMatrix, pConn['ei'])
-        print 'save connection matrix', name
-        np.save(dataPath+name, weightList)
-        
-        
-        
-    print 'create connection matrices from I->E which are purely random'
+            numEntries = int(nE * nI * pConn['ei'])
+            chunks = sparseChunks(nE, nI, pConn['ei'], weight['ei'], rng)
+        print('save connection matrix', name)
+        saveConnections(dataPath+name+WEIGHTS_EXT, (nE, nI), chunks, numEntries)
+
+
+
+    print('create connection matrices from I->E which are purely random')
     connNameList = ['AiAe']
     for name in connNameList:
         if nE == nI:
-            weightMatrix = np.ones((nI, nE))
-            weightMatrix *= weight['ie']
-            for i in xrange(nI):
-                weightMatrix[i,i] = 0
-            weightList = [(i, j, weightMatrix[i,j]) for i in xrange(nI) for j in xrange(nE)]
+            def getRows(start, stop):
+                weightMatrix = np.full((stop - start, nE), weight['ie'])
+                rows = np.arange(start, stop)
+                weightMatrix[rows - start, rows] = 0
+                return weightMatrix
+            numEntries = None
+            chunks = denseChunks(nI, nE, getRows)
         else:
-            weightMatrix = np.random.random((nI, nE))
-            weightMatrix *= weight['ie']
-            weightMatrix, weightList = sparsenMatrix(weightMatrix, pConn['ie'])
-        print 'save connection matrix', name
-        np.save(dataPath+name, weightList)
-    
-         
-if __name__ == "__main__":
-    create_weights()
-    
-
-
-
-
-
-
-
-
+            numEntries = int(nI * nE * pConn['ie'])
+            chunks = sparseChunks(nI, nE, pConn['ie'], weight['ie'], rng)
+        print('save connection matrix', name)
+        saveConnections(dataPath+name+WEIGHTS_EXT, (nI, nE), chunks, numEntries)
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create the random initial connection matrices.')
+    parser.add_argument('--n-e', type=int, default=400, help='number of excitatory neurons (default: 400)')
+    parser.add_argument('--data-path', default='./random/', help='output directory (default: ./random/)')
+    parser.add_argument('--seed', type=int, default=None, help='random seed (default: unseeded)')
+    args = parser.parse_args()
+    create_weights(args.n_e, args.data_path, args.seed)
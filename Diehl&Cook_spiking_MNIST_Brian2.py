@@ -5,6 +5,7 @@ Created on 15.12.2014
 '''
 
 
+import argparse
 import numpy as np
 import matplotlib.cm as cmap
 import time
@@ -17,63 +18,209 @@ import brian2 as b2
 from brian2tools import *
 
 from functions.data import get_labeled_data
+from functions.spikes import SpikeTrainCache, encode_poisson, example_rng, spike_cache_name
+from functions.prefetch import Prefetcher
+from functions.connections import WEIGHTS_EXT, get_weights_file, load_weights, save_weights
+from functions.checkpoint import CheckpointWriter, read_checkpoint, save_array, write_checkpoint
+from functions.intensity import IntensityPredictor
+from functions.early_exit import get_class_rates, is_decided
+from functions import model as dc_model
+from functions.model import v_rest_e, v_rest_i, v_reset_e, v_reset_i, v_thresh_e, v_thresh_i, refrac_e, refrac_i, \
+                            tc_pre_ee, tc_post_1_ee, tc_post_2_ee, wmax_ee, offset, v_thresh_e_str, v_thresh_i_str, \
+                            v_reset_i_str, neuron_eqs_i, eqs_stdp_ee, eqs_stdp_pre_ee, eqs_stdp_post_ee
+
+parser = argparse.ArgumentParser(description='Train or test the Diehl & Cook (2015) spiking network on MNIST.')
+parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint')
+parser.add_argument('--test', action='store_true', help='run in test mode, whatever test_mode is set to')
+parser.add_argument('--num-examples', type=int, help='number of examples to present, instead of num_examples')
+parser.add_argument('--first-example', type=int,
+                    help='present the examples from this one on and add the range to the output file names; '
+                         'used for the shards of functions/parallel.py')
+parser.add_argument('--seed', type=int, default=0, help='seed of the random number generators (default: 0)')
+parser.add_argument('--training-set', action='store_true', help='present the training set in test mode')
+parser.add_argument('--data-path', default='./', help='directory with weights/, random/ and activity/ (default: ./)')
+parser.add_argument('--mnist-path', default='./mnist/', help='location of the MNIST data (default: ./mnist/)')
+parser.add_argument('--rest-mode', choices=['simulate', 'decay', 'reset', 'snapshot'], help='instead of rest_mode')
+parser.add_argument('--precision', choices=['double', 'single'], help='instead of float_precision')
+# parameters that functions/sweep.py tunes; the defaults are set below
+parser.add_argument('--input-intensity', type=float, help='starting input intensity')
+parser.add_argument('--nu-ee-pre', type=float, help='presynaptic learning rate')
+parser.add_argument('--nu-ee-post', type=float, help='postsynaptic learning rate')
+parser.add_argument('--theta-plus-e', type=float, help='threshold increase per spike in mV')
+parser.add_argument('--tc-theta', type=float, help='time constant of the threshold decay in ms')
+parser.add_argument('--weight-ee-input', type=float, help='sum of the input weights of every excitatory neuron')
+args, unknown_args = parser.parse_known_args()
 
 dic = {}
 dic['j'] = 0
 # specify the location of the MNIST data
-MNIST_data_path = './mnist/'
+MNIST_data_path = args.mnist_path
 
 #%%
 #------------------------------------------------------------------------------
 # functions
 #------------------------------------------------------------------------------
 
-def get_matrix_from_file(fileName):
-    offset = len(ending) + 4
-    if fileName[-4-offset] == 'X':
-        n_src = n_input
-    else:
-        if fileName[-3-offset]=='e':
-            n_src = n_e
+def connect_from_file(conn, basename, all_to_all = False, copies = 1):
+    # Connect the synapses stored in a weight file and assign their weights in
+    # stored order. The weights are memory-mapped, there is no dense copy.
+    # With all_to_all every pair is connected and pairs missing from the
+    # file start at 0, so that plastic connections can grow new weights.
+    # With copies > 1 the source and target groups hold that many copies of
+    # the populations, one after the other, and every copy is connected to
+    # its counterpart only.
+    fileName = get_weights_file(basename)
+    weights = load_weights(fileName, (len(conn.source) // copies, len(conn.target) // copies))
+    print(weights['w'].shape, fileName)
+    n_src, n_tgt = weights['shape']
+    if (standalone_mode or copies > 1) and (weights['i'] is None or all_to_all):
+        # the synapses made by connect(True) are only known after the build,
+        # so connect every pair explicitly in row-major order
+        w = np.zeros(n_src * n_tgt)
+        if weights['i'] is None:
+            w[:] = weights['w'].reshape(-1)
+        else:
+            w[weights['i'].astype(np.int64) * n_tgt + weights['j']] = weights['w']
+        i, j = np.repeat(np.arange(n_src), n_tgt), np.tile(np.arange(n_tgt), n_src)
+        copy = np.arange(copies)[:, np.newaxis]
+        conn.connect(i = (i + copy * n_src).reshape(-1), j = (j + copy * n_tgt).reshape(-1))
+        conn.w = np.tile(w, copies)
+    elif copies > 1:
+        copy = np.arange(copies)[:, np.newaxis]
+        conn.connect(i = (np.asarray(weights['i']) + copy * n_src).reshape(-1),
+                     j = (np.asarray(weights['j']) + copy * n_tgt).reshape(-1))
+        conn.w = np.tile(weights['w'], copies)
+    elif weights['i'] is None:
+        conn.connect(True)
+        flat_w = weights['w'].reshape(-1)
+        keys = conn.i[:].astype(np.int64) * n_tgt + conn.j[:]
+        if np.array_equal(keys, np.arange(len(flat_w))):
+            conn.w = flat_w
         else:
-            n_src = n_i
-    if fileName[-1-offset]=='e':
-        n_tgt = n_e
+            conn.w = flat_w[keys]
+    elif not all_to_all:
+        conn.connect(i=np.asarray(weights['i']), j=np.asarray(weights['j']))
+        conn.w = weights['w']
     else:
-        n_tgt = n_i
-    readout = np.load(fileName)
-    print(readout.shape, fileName)
-    value_arr = np.zeros((n_src, n_tgt))
-    if not readout.shape == (0,):
-        value_arr[np.int32(readout[:,0]), np.int32(readout[:,1])] = readout[:,2]
-    return value_arr
+        conn.connect(True)
+        keys = conn.i[:].astype(np.int64) * n_tgt + conn.j[:]
+        order = np.argsort(keys)
+        pos = np.searchsorted(keys, weights['i'].astype(np.int64) * n_tgt + weights['j'], sorter=order)
+        w = np.zeros(len(keys))
+        w[order[pos]] = weights['w']
+        conn.w = w
 
 
 def save_connections(ending = ''):
+    # the weights are copied here and written by checkpoint_writer in the
+    # background while the simulation continues
     print('save connections')
     for connName in save_conns:
         conn = connections[connName]
-        connListSparse = zip(conn.i, conn.j, conn.w)
-        np.save(data_path + 'weights/' + connName + ending, connListSparse)
+        checkpoint_writer.submit(save_weights, data_path + 'weights/' + connName + ending + WEIGHTS_EXT,
+                                 np.array(conn.i[:]), np.array(conn.j[:]), np.array(conn.w[:]),
+                                 (len(conn.source), len(conn.target)))
 
 def save_theta(ending = ''):
     print('save theta')
     for pop_name in population_names:
-        np.save(data_path + 'weights/theta_' + pop_name + ending, neuron_groups[pop_name + 'e'].theta)
+        checkpoint_writer.submit(save_array, data_path + 'weights/theta_' + pop_name + ending + '.npy',
+                                 np.array(neuron_groups[pop_name + 'e'].theta))
+
+def get_normalization_targets(conn):
+    # Precomputed once per connection: None when the synapses are stored as a
+    # row-major all-to-all matrix, so that w can be viewed as a
+    # (source, target) matrix, otherwise the target index of every synapse.
+    len_source = len(conn.source)
+    len_target = len(conn.target)
+    targets = np.asarray(conn.j[:])
+    if len(targets) == len_source * len_target and \
+            np.array_equal(targets, np.tile(np.arange(len_target), len_source)):
+        return None
+    return targets
+
+def normalize_columns(connName, columns = None):
+    # scale the input weights of the given target neurons (all if None) so
+    # that they sum to weight['ee_input'], in place in the synapse weight array
+    conn = connections[connName]
+    if connName not in normalization_targets:
+        normalization_targets[connName] = get_normalization_targets(conn)
+    targets = normalization_targets[connName]
+    w = conn.variables['w'].get_value()
+    len_target = len(conn.target)
+    if targets is None:
+        w = w.reshape((-1, len_target))
+        if columns is None:
+            colSums = np.sum(w, axis = 0)
+            w *= weight['ee_input'] / colSums
+        else:
+            colSums = np.sum(w[:, columns], axis = 0)
+            w[:, columns] *= weight['ee_input'] / colSums
+    elif columns is None:
+        colSums = np.bincount(targets, weights = w, minlength = len_target)
+        w *= (weight['ee_input'] / colSums)[targets]
+    else:
+        synapses = np.flatnonzero(np.isin(targets, columns))
+        colSums = np.bincount(targets[synapses], weights = w[synapses], minlength = len_target)
+        colFactors = np.ones(len_target)
+        colFactors[columns] = weight['ee_input'] / colSums[columns]
+        w[synapses] *= colFactors[targets[synapses]]
 
 def normalize_weights():
     for connName in connections:
         if connName[1] == 'e' and connName[3] == 'e':
-            len_source = len(connections[connName].source)
-            len_target = len(connections[connName].target)
-            connection = np.zeros((len_source, len_target))
-            connection[connections[connName].i, connections[connName].j] = connections[connName].w
-            temp_conn = np.copy(connection)
-            colSums = np.sum(temp_conn, axis = 0)
-            colFactors = weight['ee_input']/colSums
-            for j in range(n_e):#
-                temp_conn[:,j] *= colFactors[j]
-            connections[connName].w = temp_conn[connections[connName].i, connections[connName].j]
+            normalize_columns(connName)
+
+def normalize_drifted_weights():
+    # Lazy normalization: the STDP rule keeps weight_sum of every target
+    # neuron up to date, and only the columns whose sum drifted more than
+    # normalization_tolerance from weight['ee_input'] are rescaled. Returns
+    # the number of rescaled columns.
+    num_columns = 0
+    for connName in connections:
+        if connName[1] == 'e' and connName[3] == 'e':
+            target = connections[connName].target
+            weight_sum = np.asarray(target.weight_sum[:])
+            if np.any(weight_sum):
+                drift = np.abs(weight_sum - weight['ee_input'])
+                columns = np.flatnonzero(drift > normalization_tolerance * weight['ee_input'])
+            else:
+                # nothing tracked yet, normalize every column once
+                columns = np.arange(len(target))
+            if len(columns) > 0:
+                normalize_columns(connName, columns)
+                target.weight_sum[columns] = weight['ee_input']
+            num_columns += len(columns)
+    return num_columns
+
+def track_weight_sum(code):
+    # make a synaptic update also add its change of w to weight_sum_post
+    return 'w_old = w; ' + code + '; weight_sum_post += w - w_old'
+
+def add_network_normalization(conn):
+    # The normalization of normalize_weights as generated code that runs in
+    # the network at the onset of every presentation: the summed variable
+    # weight_sum_post (see eqs_weight_sum) sums the weights of each target
+    # neuron into weight_sum, then w is rescaled. The summing loop is serial
+    # also with OpenMP, but it would run every time step on the clock of
+    # the target group, so it is moved to the presentation clock. Brian2 has
+    # no public way to set the clock of a summed variable, it always takes
+    # the clock of the target group; this sets the private _clock of its
+    # updater, checked to work with the Brian2 version given in README.md,
+    # and fails loudly if the updater no longer follows it.
+    normalization_clock = b2.Clock(dt = single_example_time + resting_time)
+    summed_updater = conn.summed_updaters.get('weight_sum_post')
+    if summed_updater is None or not hasattr(summed_updater, '_clock'):
+        raise RuntimeError('This Brian2 version (' + b2.__version__ + ') keeps summed variables differently, '
+                           "normalization_mode = 'network' cannot move weight_sum_post to the presentation clock")
+    summed_updater._clock = normalization_clock
+    if summed_updater.clock is not normalization_clock:
+        raise RuntimeError('This Brian2 version (' + b2.__version__ + ') does not take the clock of a summed '
+                           "variable from _clock, normalization_mode = 'network' would sum every time step")
+    summed_updater.when = 'start'
+    summed_updater.order = 0
+    conn.run_regularly('w *= %r / weight_sum_post' % weight['ee_input'],
+                       clock = normalization_clock, when = 'start', order = 1)
 
 def get_2d_input_weights():
     name = 'XeAe'
@@ -84,7 +231,8 @@ def get_2d_input_weights():
     num_values_row = num_values_col
     rearranged_weights = np.zeros((num_values_col, num_values_row))
     connMatrix = np.zeros((n_input, n_e))
-    connMatrix[connections[name].i, connections[name].j] = connections[name].w
+    first_copy = connections[name].i[:] < n_input
+    connMatrix[connections[name].i[first_copy], connections[name].j[first_copy]] = connections[name].w[first_copy]
     weight_matrix = np.copy(connMatrix)
 
     for i in range(n_e_sqrt):
@@ -140,6 +288,243 @@ def update_performance_plot(im, performance, current_example_num, fig):
     fig.canvas.draw()
     return im, performance
 
+def get_input_spikes(dataset_name, dataset, example, intensity):
+    # replay the example from its spike cache if one was written for this
+    # intensity (see functions/spikes.py), otherwise encode it the same way
+    key = (dataset_name, intensity)
+    if key not in spike_caches:
+        path = spike_cache_name(data_path, dataset_name, spike_cache_seed, intensity)
+        spike_caches[key] = None
+        if os.path.isdir(path):
+            spike_caches[key] = SpikeTrainCache(path)
+            if spike_caches[key].meta['num_steps'] != num_input_steps:
+                raise ValueError('Spike cache ' + path + ' was encoded for a different presentation time')
+    if spike_caches[key] is not None:
+        return spike_caches[key][example]
+    rates = dataset['x'][example,:,:].reshape((n_input)) / 8. * intensity
+    return encode_poisson(rates, num_input_steps, float(b2.defaultclock.dt),
+                          example_rng(spike_cache_seed, example))
+
+def get_example(j):
+    if test_mode and use_testing_set:
+        return 'testing', testing, (first_example + j)%10000
+    return 'training', training, (first_example + j)%60000
+
+def get_start_intensity(j):
+    # intensity of the first presentation of example j
+    if intensity_predictor is None:
+        return start_input_intensity
+    dataset_name, dataset, example = get_example(j)
+    return start_input_intensity + intensity_predictor.predict_steps(dataset['x'][example:example+1])[0]
+
+def prepare_input(j):
+    # runs ahead of the simulation in the prefetch thread
+    dataset_name, dataset, example = get_example(j)
+    base_rates = dataset['x'][example,:,:].reshape((n_input)) / 8.
+    spikes = None
+    if use_spike_cache:
+        spikes = tuple(np.array(a) for a in
+                       get_input_spikes(dataset_name, dataset, example, get_start_intensity(j)))
+    return base_rates, spikes
+
+def set_input(j, intensity, prepared):
+    base_rates, spikes = prepared
+    if use_spike_cache:
+        if intensity != get_start_intensity(j):
+            spikes = get_input_spikes(*get_example(j), intensity)
+        indices, steps = spikes
+        input_groups['Xe'].set_spikes(indices, steps * b2.defaultclock.dt + net.t)
+    else:
+        input_groups['Xe'].rates = base_rates *  intensity * Hz
+
+def silence_input():
+    # cached spike trains end with a whole presentation and the schedule
+    # controller silences the input during rests; a presentation cut short
+    # by the early exit drops the rest of its cached train
+    if use_spike_cache:
+        if early_exit_margin is not None:
+            input_groups['Xe'].set_spikes([], [] * b2.second)
+    elif not network_schedule:
+        for i,name in enumerate(input_population_names):
+            input_groups[name+'e'].rates = 0 * Hz
+
+def present_until_decided(j):
+    # Present example j in steps of early_exit_interval until the readout
+    # is decided (see functions/early_exit.py) or single_example_time is
+    # over, and record the class rates after every step
+    early_exit_rates[j] = np.nan
+    early_exit_totals[j] = np.nan
+    for step in range(num_early_exit_steps):
+        net.run(early_exit_interval)
+        spike_count = np.asarray(spike_counters['Ae'].count[:]) - previous_spike_count
+        early_exit_rates[j, step] = get_class_rates(exit_assignments, spike_count)
+        early_exit_totals[j, step] = np.sum(spike_count)
+        if is_decided(early_exit_rates[j, step], early_exit_totals[j, step], early_exit_margin, early_exit_min_spikes):
+            break
+    presentation_steps[j] = step + 1
+
+def rest():
+    # return the network to rest after a presentation, see rest_mode
+    global rest_duration, num_rests
+    start = time.time()
+    if rest_mode == 'simulate':
+        net.run(resting_time)
+    elif rest_mode == 'snapshot':
+        restore_rest_state()
+    else:
+        apply_rest()
+    rest_duration += time.time() - start
+    num_rests += 1
+
+def store_rest_state():
+    # Copy the state of the rested neurons, the variables of
+    # rest_state_variables. The weights and theta are left out, they do not
+    # change in test mode. The queues of delayed spikes are left out too:
+    # Brian2 has no public access to them, and net.store() would also
+    # restore the clock and the random state, so every presentation would
+    # get the same Poisson spike trains. As in the 'decay' and 'reset'
+    # modes, input spikes still in their delay arrive at the next
+    # presentation.
+    for name in ('e', 'i'):
+        group = neuron_groups[name]
+        rest_state[name] = group.get_states([var for var in rest_state_variables if var in group.variables],
+                                            units=False)
+
+def restore_rest_state():
+    # start the next presentation from the state stored by store_rest_state
+    for name in ('e', 'i'):
+        neuron_groups[name].set_states(rest_state[name], units=False)
+
+def decay_state(values, tc):
+    # in place: the values after decaying for resting_time with time constant tc
+    values *= np.exp(-float(resting_time / tc))
+
+def apply_rest():
+    # The state after resting_time without input, in one vectorized step
+    # instead of simulating it: 'decay' applies the closed-form decay of
+    # every variable, 'reset' sets v, the conductances and the STDP traces
+    # to the rest values they approach. v decays on its own time constant;
+    # the conductances it would integrate have decayed within a few ms. The
+    # clock does not advance, so the timers, the last spike times and the
+    # last updates of the event-driven traces are moved back by resting_time
+    # instead. Input spikes still in their delay arrive at the next
+    # presentation rather than during the rest.
+    for name, v_rest, tc_v in (('e', v_rest_e, 100 * b2.ms), ('i', v_rest_i, 10 * b2.ms)):
+        group = neuron_groups[name]
+        v = group.variables['v'].get_value()
+        v -= float(v_rest)
+        if rest_mode == 'decay':
+            decay_state(v, tc_v)
+        else:
+            v[:] = 0
+        v += float(v_rest)
+        group.variables['ge'].get_value()[:] = 0
+        group.variables['gi'].get_value()[:] = 0
+        group.variables['lastspike'].get_value()[:] -= float(resting_time)
+    neuron_groups['e'].variables['timer'].get_value()[:] += 0.1 * float(resting_time)
+    if not test_mode:
+        decay_state(neuron_groups['e'].variables['theta'].get_value(), tc_theta)
+    for conn in connections.values():
+        if 'lastupdate' not in conn.variables:
+            continue
+        lastupdate = conn.variables['lastupdate'].get_value()
+        elapsed = float(net.t) - lastupdate
+        for trace, tc in (('pre', tc_pre_ee), ('post1', tc_post_1_ee), ('post2', tc_post_2_ee)):
+            values = conn.variables[trace].get_value()
+            if rest_mode == 'decay':
+                values *= np.exp(-elapsed / float(tc))
+                decay_state(values, tc)
+            else:
+                values[:] = 0
+        lastupdate[:] = float(net.t)
+
+def get_schedule_tables(examples):
+    # tables of a schedule: the input rates at intensity 1 of every image
+    # used, and for every scheduled example the row of its image and its
+    # start intensity, padded to schedule_rows rows
+    dataset_name, dataset, unused = get_example(0)
+    images, rows = np.unique([get_example(j)[2] for j in examples], return_inverse = True)
+    image_table = np.zeros((schedule_rows, n_input))
+    image_table[:len(images)] = dataset['x'][images].reshape((len(images), n_input)) / 8.
+    start_intensities = [get_start_intensity(j) for j in examples]
+    pad = schedule_rows - len(examples)
+    return image_table, np.pad(rows, (0, pad), mode = 'edge'), np.pad(start_intensities, (0, pad), mode = 'edge')
+
+def set_schedule(examples):
+    # let the schedule controller present the examples, starting with the
+    # first one at its current intensity; with no examples the input is silent.
+    # The tables keep their names and shapes, so the code that reads them is
+    # the same for every block and compiled only once.
+    examples = list(examples)
+    images, rows, start_intensities = get_schedule_tables(examples or [0])
+    schedule_namespace['input_images'] = b2.TimedArray(images * Hz, dt = 1 * ms, name = 'input_images')
+    schedule_namespace['schedule_images'] = b2.TimedArray(rows.astype(float), dt = 1 * ms, name = 'schedule_images')
+    schedule_namespace['start_intensities'] = b2.TimedArray(start_intensities, dt = 1 * ms,
+                                                            name = 'start_intensities')
+    if examples and retry_counts[examples[0]] == 0:
+        schedule_controller.intensity = start_intensities[0]
+    schedule_controller.position = 0
+    schedule_controller.num_scheduled = len(examples)
+
+def get_block_spike_counts(first_spike, start_step, num_presentations):
+    # spike counts of Ae during each presentation of a schedule block, from
+    # the spikes recorded since first_spike; the block started at start_step
+    monitor = spike_counters['Ae']
+    spike_i = np.asarray(monitor.i[first_spike:])
+    spike_steps = np.round(np.asarray(monitor.t_[first_spike:]) / float(b2.defaultclock.dt)).astype(int) - start_step
+    presentation, phase = np.divmod(spike_steps, num_input_steps + num_rest_steps)
+    in_window = phase < num_input_steps
+    counts = np.bincount(presentation[in_window] * n_e + spike_i[in_window],
+                         minlength = num_presentations * n_e)
+    return counts.reshape((num_presentations, n_e))
+
+def record_example(j, current_spike_count):
+    result_monitor[j%update_interval,:] = current_spike_count
+    dataset_name, dataset, example = get_example(j)
+    input_numbers[j] = dataset['y'][example][0]
+    outputNumbers[j,:] = get_recognized_number_ranking(assignments, result_monitor[j%update_interval,:])
+    if j % 100 == 0 and j > 0:
+        print('runs done:', j, 'of', int(num_examples))
+    if j % update_interval == 0 and j > 0:
+        if do_plot_performance:
+            update_performance_plot(performance_monitor, performance, j, fig_performance)
+            print('Classification performance', performance[:(j/float(update_interval))+1])
+
+def record_presentations(block, block_counts):
+    # Replay the decisions of the schedule controller from the spike counts
+    # of the presentations of a block: an example with fewer than 5 spikes is
+    # presented again, the next example follows once it succeeded. Returns
+    # the number of examples of the block that were finished.
+    global assignments
+    finished = 0
+    for current_spike_count in block_counts:
+        if finished == len(block):
+            break
+        example = block[finished]
+        if np.sum(current_spike_count) < 5:
+            retry_counts[example] += 1
+        else:
+            if example % update_interval == 0 and example > 0:
+                assignments = get_new_assignments(result_monitor[:], input_numbers[example-update_interval : example])
+            record_example(example, current_spike_count)
+            finished += 1
+    if finished != schedule_controller.position[0]:
+        raise RuntimeError('The recorded spikes do not match the presentations of the schedule controller')
+    return finished
+
+def get_loop_state():
+    loop_state = {'j': j, 'input_intensity': input_intensity, 'assignments': assignments,
+                  'result_monitor': result_monitor, 'input_numbers': input_numbers,
+                  'outputNumbers': outputNumbers, 'previous_spike_count': previous_spike_count,
+                  'normalized_columns': normalized_columns, 'retry_counts': retry_counts,
+                  'schedule_pending': schedule_pending, 'copy_example': copy_example,
+                  'copy_intensity': copy_intensity, 'copy_rates': copy_rates,
+                  'presentation_steps': presentation_steps, 'early_exit_rates': early_exit_rates,
+                  'early_exit_totals': early_exit_totals, 'num_examples': num_examples, 'test_mode': test_mode}
+    if do_plot_performance:
+        loop_state['performance'] = performance
+    return loop_state
+
 def get_recognized_number_ranking(assignments, spike_rates):
     summed_rates = [0] * 10
     num_assignments = [0] * 10
@@ -168,12 +553,12 @@ def get_new_assignments(result_monitor, input_numbers):
 # load MNIST
 #------------------------------------------------------------------------------
 start = time.time()
-training = get_labeled_data(MNIST_data_path + 'training')
+training = get_labeled_data(MNIST_data_path + 'training', MNIST_data_path = MNIST_data_path)
 end = time.time()
 print('time needed to load training set:', end - start)
 
 start = time.time()
-testing = get_labeled_data(MNIST_data_path + 'testing', bTrain = False)
+testing = get_labeled_data(MNIST_data_path + 'testing', bTrain = False, MNIST_data_path = MNIST_data_path)
 end = time.time()
 print('time needed to load test set:', end - start)
 
@@ -182,12 +567,41 @@ print('time needed to load test set:', end - start)
 # set parameters and equations
 #------------------------------------------------------------------------------
 test_mode =False # Change this to False to retrain the network
-np.random.seed(0)
-data_path = './' # TODO: This should be a parameter
+if args.test:
+    test_mode = True
+np.random.seed(args.seed)
+data_path = args.data_path
+use_spike_cache = False # replay pre-encoded spike trains instead of a PoissonGroup
+spike_cache_seed = 0
+prefetch_depth = 8 # examples prepared ahead in a background thread, 0 to disable
+schedule_block_size = 0 # presentations simulated by one net.run, 0 for one run per example
+standalone_mode = False # build the whole run as one C++ standalone simulation
+standalone_threads = 0 # OpenMP threads of the standalone simulation, 0 to disable OpenMP
+use_intensity_predictor = False # start every example at the intensity predicted from its ink,
+                                # calibrated with functions/intensity.py
+standalone_retry_periods = 0.05 # presentation periods added to a standalone run for retries, per example
+test_copies = 1 # copies of the network in test mode, each presenting its own example in the same net.run
+normalization_mode = 'python' # 'python': normalize_weights() between runs, 'network': inside the network,
+                              # 'lazy': only the columns that drifted, see normalize_drifted_weights()
+normalization_tolerance = 0.01 # 'lazy': relative drift of a column sum that triggers its rescale
+rest_mode = 'simulate' # 'simulate': run resting_time after every presentation, 'decay': apply the
+                       # closed-form decay of the rest, 'reset': reset to rest values, see apply_rest(),
+                       # 'snapshot': in test mode, restore the state after a first rest, see store_rest_state()
+if args.rest_mode is not None:
+    rest_mode = args.rest_mode
+float_precision = 'double' # 'single': neuron and synapse variables in float32, except theta and timer
+if args.precision is not None:
+    float_precision = args.precision
+if float_precision == 'single':
+    b2.prefs.core.default_float_dtype = np.float32
+early_exit_margin = None # in test mode, end a presentation once the leading class is this far ahead (relative),
+                         # None to disable, np.inf to record whole presentations, see functions/early_exit.py
+early_exit_interval = 0.025 * b2.second # presentation time between readout checks
+early_exit_min_spikes = 10 # spikes of Ae needed to end a presentation early
 if test_mode:
     weight_path = data_path + 'weights/'
     num_examples = 100 * 1
-    use_testing_set = True
+    use_testing_set = not args.training_set
     do_plot_performance = False
     record_spikes = True
     ee_STDP_on = False
@@ -202,6 +616,14 @@ else:
     else:
         record_spikes = True
     ee_STDP_on = True
+if args.num_examples is not None:
+    num_examples = args.num_examples
+first_example = args.first_example or 0
+# suffix of the output files: the number of examples, or the range of a shard
+if args.first_example is None:
+    run_name = str(num_examples)
+else:
+    run_name = '{}-{}'.format(first_example, first_example + num_examples)
 
 
 ending = ''
@@ -211,27 +633,52 @@ n_i = n_e
 single_example_time =   0.35 * b2.second #
 resting_time = 0.15 * b2.second
 runtime = num_examples * (single_example_time + resting_time)
+num_input_steps = int(round(single_example_time / b2.defaultclock.dt))
+num_rest_steps = int(round(resting_time / b2.defaultclock.dt))
+schedule_steps = np.gcd(num_input_steps, num_rest_steps) # time step of the schedule controller
+schedule_dt = schedule_steps * b2.defaultclock.dt
+presentation_rows = num_input_steps // schedule_steps
+rest_rows = num_rest_steps // schedule_steps
+network_schedule = schedule_block_size > 0 or standalone_mode # inputs chosen by the schedule controller
+schedule_rows = int(num_examples) if standalone_mode else schedule_block_size # rows of the schedule tables
+if schedule_block_size > 0 and use_spike_cache:
+    raise ValueError('The batched schedule draws its input spikes in the network, disable use_spike_cache')
+if schedule_block_size > 0 and not test_mode and normalization_mode != 'network':
+    raise ValueError("The batched schedule needs normalization_mode = 'network' for training")
+if standalone_mode:
+    if use_spike_cache or schedule_block_size > 0:
+        raise ValueError('The standalone simulation has its own schedule, disable use_spike_cache and schedule_block_size')
+    if not test_mode and normalization_mode != 'network':
+        raise ValueError("The standalone simulation needs normalization_mode = 'network' for training")
+    if args.resume:
+        raise ValueError('A standalone simulation cannot be resumed')
+    b2.set_device('cpp_standalone', build_on_run = False)
+    b2.prefs.devices.cpp_standalone.openmp_threads = standalone_threads
+if test_copies > 1 and (not test_mode or use_spike_cache or network_schedule or standalone_mode):
+    raise ValueError('test_copies needs test_mode with a PoissonGroup input, without a schedule, spike cache or standalone mode')
+if early_exit_margin is not None and (not test_mode or test_copies > 1 or network_schedule):
+    raise ValueError('early_exit_margin needs test_mode with the presentation loop, without test_copies, a schedule or standalone mode')
+num_early_exit_steps = int(round(single_example_time / early_exit_interval))
+if rest_mode == 'snapshot' and not test_mode:
+    raise ValueError("rest_mode = 'snapshot' needs test_mode, the weights and theta change in training")
+if rest_mode != 'simulate' and (network_schedule or normalization_mode == 'network'):
+    raise ValueError("rest_mode = '" + rest_mode + "' needs the presentation loop, without a schedule, "
+                     "standalone mode or normalization_mode = 'network'")
 if num_examples <= 10000:
     update_interval = num_examples
     weight_update_interval = 20
 else:
     update_interval = 10000
     weight_update_interval = 100
+checkpoint_interval = 1000 # examples between full checkpoints, see --resume
+checkpoint_file = data_path + 'checkpoints/' + ('test' if test_mode else 'train') + ('' if args.first_example is None else '_' + run_name) + '.ckpt'
+max_checkpoints_in_flight = 2 # snapshots waiting for the background writer
 if num_examples <= 60000:
     save_connections_interval = 10000
 else:
     save_connections_interval = 10000
     update_interval = 10000
 
-v_rest_e = -65. * b2.mV
-v_rest_i = -60. * b2.mV
-v_reset_e = -65. * b2.mV
-v_reset_i = -45. * b2.mV
-v_thresh_e = -52. * b2.mV
-v_thresh_i = -40. * b2.mV
-refrac_e = 5. * b2.ms
-refrac_i = 2. * b2.ms
-
 weight = {}
 delay = {}
 input_population_names = ['X']
@@ -240,62 +687,80 @@ input_connection_names = ['XA']
 save_conns = ['XeAe']
 input_conn_names = ['ee_input']
 recurrent_conn_names = ['ei', 'ie']
-weight['ee_input'] = 78.
-delay['ee_input'] = (0*b2.ms,10*b2.ms)
-delay['ei_input'] = (0*b2.ms,5*b2.ms)
+weight['ee_input'] = dc_model.weight_ee_input
+if args.weight_ee_input is not None:
+    weight['ee_input'] = args.weight_ee_input
+delay['ee_input'] = dc_model.delay_ee_input
+delay['ei_input'] = dc_model.delay_ei_input
 input_intensity = 4.
+if args.input_intensity is not None:
+    input_intensity = args.input_intensity
 start_input_intensity = input_intensity
-
-tc_pre_ee = 20*b2.ms
-tc_post_1_ee = 20*b2.ms
-tc_post_2_ee = 40*b2.ms
-nu_ee_pre =  0.0001      # learning rate
-nu_ee_post = 0.01       # learning rate
-wmax_ee = 1.0
+intensity_predictor = None
+if use_intensity_predictor:
+    intensity_predictor = IntensityPredictor.load(data_path + 'activity/intensityPredictor.npz')
+    if intensity_predictor.start_intensity != start_input_intensity:
+        raise ValueError('The intensity predictor was calibrated for input_intensity = '
+                         + str(intensity_predictor.start_intensity))
+
+nu_ee_pre = dc_model.nu_ee_pre
+nu_ee_post = dc_model.nu_ee_post
+if args.nu_ee_pre is not None:
+    nu_ee_pre = args.nu_ee_pre
+if args.nu_ee_post is not None:
+    nu_ee_post = args.nu_ee_post
 exp_ee_pre = 0.2
 exp_ee_post = exp_ee_pre
 STDP_offset = 0.4
 
-if test_mode:
-    scr_e = 'v = v_reset_e; timer = 0*ms'
-else:
-    tc_theta = 1e7 * b2.ms
-    theta_plus_e = 0.05 * b2.mV
-    scr_e = 'v = v_reset_e; theta += theta_plus_e; timer = 0*ms'
-offset = 20.0*b2.mV
-v_thresh_e_str = '(v>(theta - offset + v_thresh_e)) and (timer>refrac_e)'
-v_thresh_i_str = 'v>v_thresh_i'
-v_reset_i_str = 'v=v_reset_i'
-
-
-neuron_eqs_e = '''
-        dv/dt = ((v_rest_e - v) + (I_synE+I_synI) / nS) / (100*ms)  : volt (unless refractory)
-        I_synE = ge * nS *         -v                           : amp
-        I_synI = gi * nS * (-100.*mV-v)                          : amp
-        dge/dt = -ge/(1.0*ms)                                   : 1
-        dgi/dt = -gi/(2.0*ms)                                  : 1
+scr_e = dc_model.get_reset_e(test_mode)
+if not test_mode:
+    tc_theta = dc_model.tc_theta
+    theta_plus_e = dc_model.theta_plus_e
+    if args.tc_theta is not None:
+        tc_theta = args.tc_theta * b2.ms
+    if args.theta_plus_e is not None:
+        theta_plus_e = args.theta_plus_e * b2.mV
+if network_schedule:
+    scr_e += '; spike_count += 1'
+
+
+neuron_eqs_e = dc_model.get_neuron_eqs_e(test_mode)
+if not test_mode and normalization_mode in ('network', 'lazy'):
+    neuron_eqs_e += '\n  weight_sum  : 1'
+if network_schedule:
+    neuron_eqs_e += '\n  spike_count  : 1'
+
+eqs_weight_sum = '\n  weight_sum_post = w  : 1 (summed)'
+
+# The schedule controller presents the scheduled examples one after the
+# other, each for single_example_time followed by resting_time. At the end of
+# a presentation with fewer than 5 spikes of Ae, it presents the same example
+# again with the intensity raised by 1; otherwise it moves on to the next
+# example at its start intensity. It runs once per schedule_dt.
+schedule_eqs = '''
+        position        : integer # scheduled example being presented
+        phase           : integer # schedule step within the presentation and rest
+        intensity       : 1
+        num_scheduled   : integer
+        total_spikes    : 1 # spikes of Ae so far, see schedule_counter
+        window_start    : 1 # total_spikes at the start of the presentation
         '''
-if test_mode:
-    neuron_eqs_e += '\n  theta      :volt'
-else:
-    neuron_eqs_e += '\n  dtheta/dt = -theta / (tc_theta)  : volt'
-neuron_eqs_e += '\n  dtimer/dt = 0.1  : second'
-
-neuron_eqs_i = '''
-        dv/dt = ((v_rest_i - v) + (I_synE+I_synI) / nS) / (10*ms)  : volt (unless refractory)
-        I_synE = ge * nS *         -v                           : amp
-        I_synI = gi * nS * (-85.*mV-v)                          : amp
-        dge/dt = -ge/(1.0*ms)                                   : 1
-        dgi/dt = -gi/(2.0*ms)                                  : 1
+schedule_code = '''
+        phase = (phase + 1) % (presentation_rows + rest_rows)
+        window_start += int(phase == 0) * (total_spikes - window_start)
+        window_end = int(phase == presentation_rows) * int(position < num_scheduled)
+        failed = window_end * int(total_spikes - window_start < 5)
+        position += window_end - failed
+        intensity += failed - (window_end - failed) * (intensity - start_intensities(position * ms))
+        '''
+input_eqs_schedule = '''
+        rates = int(phase < presentation_rows) * int(position < num_scheduled) * intensity * input_images(schedule_images(position * ms) * ms, i)  : Hz
+        position        : integer (linked)
+        phase           : integer (linked)
+        intensity       : 1 (linked)
+        num_scheduled   : integer (linked)
         '''
-eqs_stdp_ee = '''
-                post2before                            : 1
-                dpre/dt   =   -pre/(tc_pre_ee)         : 1 (event-driven)
-                dpost1/dt  = -post1/(tc_post_1_ee)     : 1 (event-driven)
-                dpost2/dt  = -post2/(tc_post_2_ee)     : 1 (event-driven)
-            '''
-eqs_stdp_pre_ee = 'pre = 1.; w = clip(w + nu_ee_pre * post1, 0, wmax_ee)'
-eqs_stdp_post_ee = 'post2before = post2; w = clip(w + nu_ee_post * pre * post2before, 0, wmax_ee); post1 = 1.; post2 = 1.'
 
 
 b2.ion()
@@ -307,9 +772,25 @@ rate_monitors = {}
 spike_monitors = {}
 spike_counters = {}
 result_monitor = np.zeros((update_interval,n_e))
-
-neuron_groups['e'] = b2.NeuronGroup(n_e*len(population_names), neuron_eqs_e, threshold= v_thresh_e_str, refractory= refrac_e, reset= scr_e, method='euler')
-neuron_groups['i'] = b2.NeuronGroup(n_i*len(population_names), neuron_eqs_i, threshold= v_thresh_i_str, refractory= refrac_i, reset= v_reset_i_str, method='euler')
+spike_caches = {}
+schedule_namespace = {'presentation_rows': presentation_rows, 'rest_rows': rest_rows}
+schedule_pending = [] # examples of the last schedule block that were not finished
+retry_counts = np.zeros(num_examples, dtype = int) # repeated presentations of every example
+normalization_targets = {}
+rest_state = {} # dynamic state of the rested network, see store_rest_state()
+rest_state_variables = ['v', 'ge', 'gi', 'timer', 'lastspike', 'not_refractory']
+rest_duration = 0. # wall-clock time spent in rest()
+num_exit_examples = num_examples if early_exit_margin is not None else 0
+presentation_steps = np.zeros(num_exit_examples, dtype = int) # early exit: steps of the last presentation of every example
+early_exit_rates = np.zeros((num_exit_examples, num_early_exit_steps, 10)) # class rates after every step
+early_exit_totals = np.zeros((num_exit_examples, num_early_exit_steps)) # spikes of Ae after every step
+exit_assignments = None
+if early_exit_margin is not None:
+    exit_assignments = np.load(data_path + 'activity/assignments.npy')
+num_rests = 0
+
+neuron_groups['e'] = b2.NeuronGroup(n_e*len(population_names)*test_copies, neuron_eqs_e, threshold= v_thresh_e_str, refractory= refrac_e, reset= scr_e, method='euler', dtype= dc_model.high_precision_dtypes)
+neuron_groups['i'] = b2.NeuronGroup(n_i*len(population_names)*test_copies, neuron_eqs_i, threshold= v_thresh_i_str, refractory= refrac_i, reset= v_reset_i_str, method='euler')
 
 
 #------------------------------------------------------------------------------
@@ -318,20 +799,19 @@ neuron_groups['i'] = b2.NeuronGroup(n_i*len(population_names), neuron_eqs_i, thr
 for subgroup_n, name in enumerate(population_names):
     print('create neuron group', name)
 
-    neuron_groups[name+'e'] = neuron_groups['e'][subgroup_n*n_e:(subgroup_n+1)*n_e]
-    neuron_groups[name+'i'] = neuron_groups['i'][subgroup_n*n_i:(subgroup_n+1)*n_e]
+    neuron_groups[name+'e'] = neuron_groups['e'][subgroup_n*n_e*test_copies:(subgroup_n+1)*n_e*test_copies]
+    neuron_groups[name+'i'] = neuron_groups['i'][subgroup_n*n_i*test_copies:(subgroup_n+1)*n_e*test_copies]
 
     neuron_groups[name+'e'].v = v_rest_e - 40. * b2.mV
     neuron_groups[name+'i'].v = v_rest_i - 40. * b2.mV
     if test_mode or weight_path[-8:] == 'weights/':
-        neuron_groups['e'].theta = np.load(weight_path + 'theta_' + name + ending + '.npy') * b2.volt
+        neuron_groups['e'].theta = np.tile(np.load(weight_path + 'theta_' + name + ending + '.npy'), test_copies) * b2.volt
     else:
         neuron_groups['e'].theta = np.ones((n_e)) * 20.0*b2.mV
 
     print('create recurrent connections')
     for conn_type in recurrent_conn_names:
         connName = name+conn_type[0]+name+conn_type[1]
-        weightMatrix = get_matrix_from_file(weight_path + '../random/' + connName + ending + '.npy')
         model = 'w : 1'
         pre = 'g%s_post += w' % conn_type[0]
         post = ''
@@ -342,12 +822,12 @@ for subgroup_n, name in enumerate(population_names):
                 post = eqs_stdp_post_ee
         connections[connName] = b2.Synapses(neuron_groups[connName[0:2]], neuron_groups[connName[2:4]],
                                                     model=model, on_pre=pre, on_post=post)
-        connections[connName].connect(True) # all-to-all connection
-        connections[connName].w = weightMatrix[connections[connName].i, connections[connName].j]
+        connect_from_file(connections[connName], weight_path + '../random/' + connName + ending, copies = test_copies)
 
     print('create monitors for', name)
-    rate_monitors[name+'e'] = b2.PopulationRateMonitor(neuron_groups[name+'e'])
-    rate_monitors[name+'i'] = b2.PopulationRateMonitor(neuron_groups[name+'i'])
+    if not standalone_mode: # a standalone run would hold the rates of every time step in memory
+        rate_monitors[name+'e'] = b2.PopulationRateMonitor(neuron_groups[name+'e'])
+        rate_monitors[name+'i'] = b2.PopulationRateMonitor(neuron_groups[name+'i'])
     spike_counters[name+'e'] = b2.SpikeMonitor(neuron_groups[name+'e'])
 
     if record_spikes:
@@ -359,23 +839,49 @@ for subgroup_n, name in enumerate(population_names):
 # create input population and connections from input populations
 #------------------------------------------------------------------------------
 pop_values = [0,0,0]
+if network_schedule:
+    schedule_controller = b2.NeuronGroup(1, schedule_eqs, dt = schedule_dt, namespace = schedule_namespace)
+    schedule_controller.phase = presentation_rows + rest_rows - 1
+    schedule_controller.intensity = start_input_intensity
+    schedule_controller.run_regularly(schedule_code, when = 'groups')
+    schedule_counter = b2.Synapses(neuron_groups['Ae'], schedule_controller,
+                                   model = 'total_spikes_post = spike_count_pre  : 1 (summed)')
+    schedule_counter.connect(True)
+    set_schedule([])
 for i,name in enumerate(input_population_names):
-    input_groups[name+'e'] = b2.PoissonGroup(n_input, 0*Hz)
-    rate_monitors[name+'e'] = b2.PopulationRateMonitor(input_groups[name+'e'])
+    if use_spike_cache:
+        input_groups[name+'e'] = b2.SpikeGeneratorGroup(n_input, [], []*second)
+    elif network_schedule:
+        # Poisson input with the rates of the example chosen by the schedule
+        # controller; the image lookups use the index as the "time" of the
+        # TimedArrays set by set_schedule
+        input_groups[name+'e'] = b2.NeuronGroup(n_input, input_eqs_schedule, threshold = 'rand() < rates * dt',
+                                                namespace = schedule_namespace)
+        for var in ['position', 'phase', 'intensity', 'num_scheduled']:
+            setattr(input_groups[name+'e'], var,
+                    b2.linked_var(schedule_controller, var, index = np.zeros(n_input, dtype = int)))
+    else:
+        input_groups[name+'e'] = b2.PoissonGroup(n_input*test_copies, 0*Hz)
+    if not standalone_mode:
+        rate_monitors[name+'e'] = b2.PopulationRateMonitor(input_groups[name+'e'])
 
 for name in input_connection_names:
     print('create connections between', name[0], 'and', name[1])
     for connType in input_conn_names:
         connName = name[0] + connType[0] + name[1] + connType[1]
-        weightMatrix = get_matrix_from_file(weight_path + connName + ending + '.npy')
         model = 'w : 1'
         pre = 'g%s_post += w' % connType[0]
         post = ''
+        if not test_mode and normalization_mode == 'network' and connName[1] == 'e' and connName[3] == 'e':
+            model += eqs_weight_sum
         if ee_STDP_on:
             print('create STDP for connection', name[0]+'e'+name[1]+'e')
             model += eqs_stdp_ee
             pre += '; ' + eqs_stdp_pre_ee
             post = eqs_stdp_post_ee
+            if normalization_mode == 'lazy' and connName[1] == 'e' and connName[3] == 'e':
+                pre = track_weight_sum(pre)
+                post = track_weight_sum(post)
 
         connections[connName] = b2.Synapses(input_groups[connName[0:2]], neuron_groups[connName[2:4]],
                                                     model=model, on_pre=pre, on_post=post)
@@ -383,9 +889,10 @@ for name in input_connection_names:
         maxDelay = delay[connType][1]
         deltaDelay = maxDelay - minDelay
         # TODO: test this
-        connections[connName].connect(True) # all-to-all connection
+        connect_from_file(connections[connName], weight_path + connName + ending, all_to_all = True, copies = test_copies)
         connections[connName].delay = 'minDelay + rand() * deltaDelay'
-        connections[connName].w = weightMatrix[connections[connName].i, connections[connName].j]
+        if not test_mode and normalization_mode == 'network' and connName[1] == 'e' and connName[3] == 'e':
+            add_network_normalization(connections[connName])
 
 
 #------------------------------------------------------------------------------
@@ -397,36 +904,161 @@ for obj_list in [neuron_groups, input_groups, connections, rate_monitors,
         spike_monitors, spike_counters]:
     for key in obj_list:
         net.add(obj_list[key])
+if network_schedule:
+    net.add(schedule_controller, schedule_counter)
 
-previous_spike_count = np.zeros(n_e)
+previous_spike_count = np.zeros(n_e*test_copies)
+copy_example = np.full(test_copies, -1) # example presented by each copy, -1 when it is idle
+copy_intensity = np.zeros(test_copies)
+copy_rates = np.zeros((test_copies, n_input))
 assignments = np.zeros(n_e)
 input_numbers = [0] * num_examples
 outputNumbers = np.zeros((num_examples, 10))
-if not test_mode:
+normalized_columns = np.zeros(num_examples, dtype = int) # 'lazy': columns rescaled for every example, retries included
+if not test_mode and not standalone_mode:
     input_weight_monitor, fig_weights = plot_2d_input_weights()
     fig_num += 1
 if do_plot_performance:
     performance_monitor, performance, fig_num, fig_performance = plot_performance(fig_num)
-for i,name in enumerate(input_population_names):
-    input_groups[name+'e'].rates = 0 * Hz
-net.run(0*second)
 j = 0
-while j < (int(num_examples)):
+input_intensity = get_start_intensity(j)
+if standalone_mode:
+    # the whole schedule compiles and runs at once, with some presentation
+    # periods to spare for retries; the spike counts of the presentations are
+    # read from the spike monitor afterwards
+    num_periods = int(np.ceil(num_examples * (1 + standalone_retry_periods)))
+    set_schedule(range(int(num_examples)))
+    net.run(num_periods * (single_example_time + resting_time), report='text')
+    b2.device.build(directory = data_path + 'standalone' + ('' if args.first_example is None else '_' + run_name) + '/')
+    j = record_presentations(range(int(num_examples)), get_block_spike_counts(0, 0, num_periods))
+    if j < num_examples:
+        print('the run ended before', int(num_examples) - j, 'examples were presented, increase standalone_retry_periods')
+else:
+    silence_input()
+    net.run(0*second)
+if args.resume:
+    loop_state = read_checkpoint(checkpoint_file, net)
+    if loop_state['test_mode'] != test_mode or loop_state['num_examples'] != num_examples:
+        raise ValueError('The checkpoint ' + checkpoint_file + ' belongs to a different run configuration')
+    j = loop_state['j']
+    input_intensity = loop_state['input_intensity']
+    assignments = loop_state['assignments']
+    result_monitor = loop_state['result_monitor']
+    input_numbers = loop_state['input_numbers']
+    outputNumbers = loop_state['outputNumbers']
+    previous_spike_count = loop_state['previous_spike_count']
+    normalized_columns = loop_state['normalized_columns']
+    retry_counts = loop_state['retry_counts']
+    schedule_pending = loop_state['schedule_pending']
+    copy_example = loop_state['copy_example']
+    copy_intensity = loop_state['copy_intensity']
+    copy_rates = loop_state['copy_rates']
+    presentation_steps = loop_state['presentation_steps']
+    early_exit_rates = loop_state['early_exit_rates']
+    early_exit_totals = loop_state['early_exit_totals']
+    if do_plot_performance:
+        performance = loop_state['performance']
+    print('resume from example', j, 'at', net.t)
+checkpoint_writer = CheckpointWriter(max_checkpoints_in_flight)
+if test_mode and not network_schedule and (not args.resume or rest_mode == 'snapshot'):
+    # a rest before the first presentation lets the threshold timers run
+    # out, otherwise the first example of a run, and so of every shard of
+    # functions/parallel.py, gets a synchronous volley
+    net.run(resting_time)
+if rest_mode == 'snapshot':
+    # every presentation starts from the state of the network after the first rest
+    store_rest_state()
+input_prefetcher = None
+if prefetch_depth > 0 and not network_schedule:
+    input_prefetcher = Prefetcher(prepare_input, range(j, int(num_examples)), prefetch_depth)
+while schedule_block_size > 0 and (j < int(num_examples) or schedule_pending):
+    # one net.run for a block of schedule_block_size presentation periods:
+    # first the examples the last block did not finish, then the next ones
+    previous_j = j
+    block = list(schedule_pending)
+    while len(block) < schedule_block_size and j < int(num_examples):
+        block.append(j)
+        j += 1
+    print ('corrida Nº:', previous_j, 'to', j - 1, 'and', len(schedule_pending), 'unfinished examples')
+    dic['j'] = j
+    set_schedule(block)
+    first_spike = spike_counters['Ae'].num_spikes
+    start_step = int(round(net.t / b2.defaultclock.dt))
+    net.run(len(block) * (single_example_time + resting_time), report='text')
+
+    block_counts = get_block_spike_counts(first_spike, start_step, len(block))
+    schedule_pending = block[record_presentations(block, block_counts):]
+    print('repeated presentations:', int(np.sum(retry_counts[block])))
+    previous_spike_count = np.copy(spike_counters['Ae'].count[:])
+
+    if previous_j // 50 < j // 50:
+        plot_2d_input_weights()
+    if previous_j // weight_update_interval < j // weight_update_interval and not test_mode:
+        update_2d_input_weights(input_weight_monitor, fig_weights)
+    if previous_j // save_connections_interval < j // save_connections_interval and not test_mode:
+        save_connections(str(j))
+        save_theta(str(j))
+    if previous_j // checkpoint_interval < j // checkpoint_interval:
+        write_checkpoint(checkpoint_file, net, get_loop_state(), checkpoint_writer)
+while test_copies > 1 and (j < int(num_examples) or np.any(copy_example >= 0)):
+    # one net.run presents an example on every copy: idle copies take the
+    # next examples, the others repeat theirs with a higher intensity
+    previous_j = j
+    for copy in np.flatnonzero(copy_example < 0)[:int(num_examples) - j]:
+        copy_example[copy] = j
+        copy_intensity[copy] = get_start_intensity(j)
+        if input_prefetcher is not None:
+            copy_rates[copy] = input_prefetcher.get(j)[0]
+        else:
+            copy_rates[copy] = prepare_input(j)[0]
+        j += 1
+    print ('corrida Nº:', previous_j, 'to', j - 1, 'and', np.count_nonzero(retry_counts[copy_example[copy_example >= 0]]), 'repeated')
+    dic['j'] = j
+    if previous_j // 50 < j // 50:
+        plot_2d_input_weights()
+    input_groups['Xe'].rates = (copy_rates * copy_intensity[:, np.newaxis]).reshape(-1) * Hz
+    net.run(single_example_time, report='text')
+
+    copy_counts = (np.asarray(spike_counters['Ae'].count[:]) - previous_spike_count).reshape((test_copies, n_e))
+    previous_spike_count = np.copy(spike_counters['Ae'].count[:])
+    silence_input()
+    rest()
+    for copy in np.flatnonzero(copy_example >= 0):
+        example = copy_example[copy]
+        if np.sum(copy_counts[copy]) < 5:
+            copy_intensity[copy] += 1
+            retry_counts[example] += 1
+        else:
+            if example % update_interval == 0 and example > 0:
+                assignments = get_new_assignments(result_monitor[:], input_numbers[example-update_interval : example])
+            record_example(example, copy_counts[copy])
+            copy_example[copy] = -1
+            copy_rates[copy] = 0
+    if previous_j // checkpoint_interval < j // checkpoint_interval:
+        write_checkpoint(checkpoint_file, net, get_loop_state(), checkpoint_writer)
+while not standalone_mode and j < int(num_examples):
     print ('corrida Nº:', j)
     dic['j'] = j
     if j%50==0:
         plot_2d_input_weights()
-    if test_mode:
-        if use_testing_set:
-            spike_rates = testing['x'][j%10000,:,:].reshape((n_input)) / 8. *  input_intensity
-        else:
-            spike_rates = training['x'][j%60000,:,:].reshape((n_input)) / 8. *  input_intensity
-    else:
+    if not test_mode and normalization_mode == 'python':
         normalize_weights()
-        spike_rates = training['x'][j%60000,:,:].reshape((n_input)) / 8. *  input_intensity
-    input_groups['Xe'].rates = spike_rates * Hz
+    elif not test_mode and normalization_mode == 'lazy':
+        # a repeated presentation normalizes the same example again
+        num_columns = normalize_drifted_weights()
+        normalized_columns[j] += num_columns
+        print('columns normalized:', num_columns)
+    if retry_counts[j] == 0:
+        if input_prefetcher is not None:
+            prepared_input = input_prefetcher.get(j)
+        else:
+            prepared_input = prepare_input(j)
+    set_input(j, input_intensity, prepared_input)
 #     print('run number:', j+1, 'of', int(num_examples))
-    net.run(single_example_time, report='text')
+    if early_exit_margin is None:
+        net.run(single_example_time, report='text')
+    else:
+        present_until_decided(j)
 
     if j % update_interval == 0 and j > 0:
         assignments = get_new_assignments(result_monitor[:], input_numbers[j-update_interval : j])
@@ -439,41 +1071,54 @@ while j < (int(num_examples)):
     current_spike_count = np.asarray(spike_counters['Ae'].count[:]) - previous_spike_count
     previous_spike_count = np.copy(spike_counters['Ae'].count[:])
     if np.sum(current_spike_count) < 5:
+        # present the same example again with a higher intensity
         input_intensity += 1
-        for i,name in enumerate(input_population_names):
-            input_groups[name+'e'].rates = 0 * Hz
-        net.run(resting_time)
+        retry_counts[j] += 1
+        silence_input()
+        rest()
     else:
-        result_monitor[j%update_interval,:] = current_spike_count
-        if test_mode and use_testing_set:
-            input_numbers[j] = testing['y'][j%10000][0]
-        else:
-            input_numbers[j] = training['y'][j%60000][0]
-        outputNumbers[j,:] = get_recognized_number_ranking(assignments, result_monitor[j%update_interval,:])
-        if j % 100 == 0 and j > 0:
-            print('runs done:', j, 'of', int(num_examples))
-        if j % update_interval == 0 and j > 0:
-            if do_plot_performance:
-                unused, performance = update_performance_plot(performance_monitor, performance, j, fig_performance)
-                print('Classification performance', performance[:(j/float(update_interval))+1])
-        for i,name in enumerate(input_population_names):
-            input_groups[name+'e'].rates = 0 * Hz
-        net.run(resting_time)
-        input_intensity = start_input_intensity
-    j += 1
+        record_example(j, current_spike_count)
+        silence_input()
+        rest()
+        j += 1
+        if j < num_examples:
+            input_intensity = get_start_intensity(j)
+        if j % checkpoint_interval == 0:
+            write_checkpoint(checkpoint_file, net, get_loop_state(), checkpoint_writer)
+if input_prefetcher is not None:
+    input_prefetcher.close()
+if not test_mode and normalization_mode == 'lazy':
+    print('columns normalized per example:', np.mean(normalized_columns), 'of', n_e)
+print('repeated presentations:', np.sum(retry_counts), 'for', np.count_nonzero(retry_counts), 'examples,',
+      'retry rate:', np.mean(retry_counts))
+if early_exit_margin is not None:
+    print('mean presentation time with early exit:', np.mean(presentation_steps) * early_exit_interval,
+          'of', single_example_time)
+if num_rests > 0:
+    print('time needed for the rests:', rest_duration, 's,', rest_duration / num_rests, 's per rest with rest_mode =', rest_mode)
+print('simulated time of repeated presentations:', np.sum(retry_counts) * (single_example_time + resting_time))
+if intensity_predictor is not None:
+    print('simulated time saved against the calibration run:', (intensity_predictor.baseline_retries
+          - np.mean(retry_counts)) * num_examples * (single_example_time + resting_time))
 
 
-# #------------------------------------------------------------------------------
-# # save results
-# #------------------------------------------------------------------------------
-# print('save results')
-# if not test_mode:
-#     save_theta()
-# if not test_mode:
-#     save_connections()
-# else:
-#     np.save(data_path + 'activity/resultPopVecs' + str(num_examples), result_monitor)
-#     np.save(data_path + 'activity/inputNumbers' + str(num_examples), input_numbers)
+#------------------------------------------------------------------------------
+# save results
+#------------------------------------------------------------------------------
+print('save results')
+if not test_mode:
+    save_theta()
+if not test_mode:
+    save_connections()
+else:
+    np.save(data_path + 'activity/resultPopVecs' + run_name, result_monitor)
+    np.save(data_path + 'activity/inputNumbers' + run_name, input_numbers)
+    if early_exit_margin is not None:
+        np.savez(data_path + 'activity/earlyExit' + run_name, class_rates = early_exit_rates,
+                 spike_totals = early_exit_totals, presentation_steps = presentation_steps,
+                 interval = float(early_exit_interval), margin = early_exit_margin)
+np.save(data_path + 'activity/retryCounts' + run_name, retry_counts)
+checkpoint_writer.close()
 
 
 # #------------------------------------------------------------------------------
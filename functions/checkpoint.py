@@ -0,0 +1,168 @@
+'''
+Functions for checkpointing and resuming a simulation.
+
+A checkpoint file is a pickle in the format written by
+Network.store(name, filename): a dict with the network state under
+CHECKPOINT_NAME, plus the state of the Python loop that drives the
+network under LOOP_STATE_NAME.
+
+Writing is split in two steps: a snapshot copies the state, which is cheap,
+and a CheckpointWriter serializes and writes the snapshot in a background
+thread while the simulation continues.
+'''
+
+import os
+import copy
+import atexit
+import queue
+import pickle
+import threading
+import numpy as np
+from brian2 import get_device
+
+CHECKPOINT_NAME = 'checkpoint'
+LOOP_STATE_NAME = 'loop_state'
+
+
+def reset_random_buffers():
+    """ Discard the random numbers Brian2 has buffered for generated code.
+        The Cython buffer is referenced by a raw pointer that cannot be
+        restored in another process; once it is empty, the next numbers are
+        drawn from numpy's generator, whose state is part of a checkpoint.
+    """
+    device = get_device()
+    for name in ('rand_buffer_index', 'randn_buffer_index'):
+        if hasattr(device, name):
+            getattr(device, name)[:] = 0
+
+
+def write_atomic(fileName, write):
+    """ Call write(f) on a temporary file, fsync it and move it to fileName,
+        so that fileName always holds either the old or the complete new file.
+    """
+    directory = os.path.dirname(fileName)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmpName = '{}.{}.tmp'.format(fileName, os.getpid())
+    with open(tmpName, mode='wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpName, fileName)
+
+
+def save_array(fileName, array):
+    """ Atomically save an array in .npy format to fileName.
+    """
+    write_atomic(fileName, lambda f: np.save(f, array))
+
+
+class CheckpointWriter(object):
+    """ Run write jobs in a background thread, in the order they were
+        submitted. At most max_pending jobs are queued or being written;
+        submit blocks while that many are in flight, which bounds the memory
+        held by snapshots. Errors raised by a job are re-raised by the next
+        call to submit, wait or close. Pending jobs are also written when the
+        interpreter exits, e.g. after an exception in the simulation loop.
+        max_pending: Maximum number of jobs in flight.
+    """
+
+    def __init__(self, max_pending=2):
+        self._queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            write, args = job
+            try:
+                if self._error is None:
+                    write(*args)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._slots.release()
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, write, *args):
+        """ Call write(*args) in the background. The arguments must not be
+            modified afterwards, so pass copies of live data.
+        """
+        self._raise_error()
+        self._slots.acquire()
+        self._queue.put((write, args))
+
+    def wait(self):
+        """ Wait until all submitted jobs are written.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """ Write the remaining jobs and stop the thread.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+
+def snapshot_checkpoint(net, loop_state):
+    """ Return a copy of the network and loop state, in the format of a
+        checkpoint file, that is independent of the running simulation.
+        net: The Brian2 Network.
+        loop_state: Picklable dict with the state of the simulation loop.
+    """
+    reset_random_buffers()
+    # without a filename, Network.store keeps a copy of the state in memory
+    net.store(CHECKPOINT_NAME)
+    return {CHECKPOINT_NAME: net._stored_state.pop(CHECKPOINT_NAME),
+            LOOP_STATE_NAME: copy.deepcopy(loop_state)}
+
+
+def dump_checkpoint(fileName, checkpoint):
+    """ Atomically write a snapshot from snapshot_checkpoint to fileName.
+    """
+    write_atomic(fileName, lambda f: pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def write_checkpoint(fileName, net, loop_state, writer=None):
+    """ Write the network and loop state to fileName.
+        fileName: Path of the checkpoint file.
+        net: The Brian2 Network.
+        loop_state: Picklable dict with the state of the simulation loop.
+        writer: CheckpointWriter that writes the file in the background, or
+            None to write it before returning.
+    """
+    checkpoint = snapshot_checkpoint(net, loop_state)
+    if writer is None:
+        dump_checkpoint(fileName, checkpoint)
+    else:
+        writer.submit(dump_checkpoint, fileName, checkpoint)
+
+
+def read_checkpoint(fileName, net):
+    """ Restore the network and numpy's random number generator from
+        fileName and return the stored loop state.
+        fileName: Path of the checkpoint file.
+        net: The Brian2 Network, built with the same objects as when the
+            checkpoint was written.
+    """
+    with open(fileName, mode='rb') as f:
+        checkpoint = pickle.load(f)
+    net.restore(CHECKPOINT_NAME, filename=fileName)
+    np.random.set_state(checkpoint[CHECKPOINT_NAME]['_random_generator_state']['numpy_state'])
+    reset_random_buffers()
+    return checkpoint[LOOP_STATE_NAME]
@@ -0,0 +1,172 @@
+'''
+Functions for saving and loading connection weights.
+
+A weight file ('.weights') starts with a 32-byte little-endian header: the
+magic 'DCWF', the format version, the layout, the number of source and
+target neurons and the number of stored weights. The header is followed by
+the weights in one of two layouts:
+    LAYOUT_SPARSE: i (int32), j (int32) and w (float32), one entry per synapse
+    LAYOUT_DENSE: w (float32) as an (n_src, n_tgt) row-major matrix; used
+        for all-to-all connections, which need no indices
+Legacy '.npy' files holding an (N, 3) float64 array of (i, j, w) rows can
+still be read.
+'''
+
+import os
+import numpy as np
+from struct import Struct
+
+WEIGHTS_EXT = '.weights'
+WEIGHTS_MAGIC = b'DCWF'
+WEIGHTS_VERSION = 1
+WEIGHTS_HEADER = Struct('<4sIIIIQ4x')  # magic, version, layout, n_src, n_tgt, nnz
+LAYOUT_SPARSE = 0
+LAYOUT_DENSE = 1
+
+
+class WeightsWriter(object):
+    """ Write a weight file chunk by chunk, so that large connections never
+        have to be held in memory. The file is written under a temporary
+        name and moved into place by close().
+        fileName: Path of the weight file.
+        shape: (n_src, n_tgt) of the connection.
+        nnz: Number of stored weights, or None for the dense layout.
+    """
+
+    def __init__(self, fileName, shape, nnz=None):
+        self.fileName = fileName
+        self.shape = tuple(int(n) for n in shape)
+        self.dense = nnz is None
+        self.nnz = self.shape[0] * self.shape[1] if self.dense else int(nnz)
+        self.pos = 0
+        self.tmpName = '{}.{}.tmp'.format(fileName, os.getpid())
+        self.f = open(self.tmpName, mode='wb')
+        layout = LAYOUT_DENSE if self.dense else LAYOUT_SPARSE
+        self.f.write(WEIGHTS_HEADER.pack(WEIGHTS_MAGIC, WEIGHTS_VERSION, layout,
+                                         self.shape[0], self.shape[1], self.nnz))
+        self.f.truncate(WEIGHTS_HEADER.size + self.nnz * (4 if self.dense else 12))
+
+    def write(self, i, j, w):
+        """ Append a chunk of weights w[k] for the pairs (i[k], j[k]) to a
+            sparse file.
+        """
+        if self.dense:
+            raise ValueError('Use write_rows for dense weight files')
+        n = len(w)
+        if self.pos + n > self.nnz:
+            raise ValueError('Too many weights for {}'.format(self.fileName))
+        for k, (values, dtype) in enumerate(((i, '<i4'), (j, '<i4'), (w, '<f4'))):
+            self.f.seek(WEIGHTS_HEADER.size + 4 * (k * self.nnz + self.pos))
+            self.f.write(np.asarray(values, dtype=dtype).tobytes())
+        self.pos += n
+
+    def write_rows(self, rows):
+        """ Append a block of complete rows, shape (k, n_tgt), to a dense file.
+        """
+        if not self.dense:
+            raise ValueError('Use write for sparse weight files')
+        rows = np.asarray(rows, dtype='<f4').reshape((-1, self.shape[1]))
+        if self.pos + rows.size > self.nnz:
+            raise ValueError('Too many weights for {}'.format(self.fileName))
+        self.f.seek(WEIGHTS_HEADER.size + 4 * self.pos)
+        self.f.write(rows.tobytes())
+        self.pos += rows.size
+
+    def close(self):
+        """ Check that all weights were written and move the file into place.
+        """
+        if self.pos != self.nnz:
+            self.f.close()
+            os.remove(self.tmpName)
+            raise ValueError('Wrote {} of {} weights to {}'.format(self.pos, self.nnz, self.fileName))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        os.replace(self.tmpName, self.fileName)
+
+
+def save_weights(fileName, i, j, w, shape):
+    """ Save the weights of a connection, choosing the dense layout when every
+        (source, target) pair is present exactly once.
+        fileName: Path of the weight file.
+        i, j: Source and target index of every synapse.
+        w: Weight of every synapse.
+        shape: (n_src, n_tgt) of the connection.
+    """
+    n_src, n_tgt = shape
+    i = np.asarray(i, dtype=np.int64)
+    j = np.asarray(j, dtype=np.int64)
+    if len(w) == n_src * n_tgt:
+        flat = i * n_tgt + j
+        if np.bincount(flat, minlength=n_src * n_tgt).max() == 1:
+            matrix = np.empty(n_src * n_tgt, dtype=np.float32)
+            matrix[flat] = w
+            writer = WeightsWriter(fileName, shape)
+            writer.write_rows(matrix)
+            writer.close()
+            return
+    writer = WeightsWriter(fileName, shape, len(w))
+    writer.write(i, j, w)
+    writer.close()
+
+
+def get_weights_file(basename):
+    """ Return the weight file for a connection: '<basename>.weights' if it
+        exists, else the legacy '<basename>.npy'.
+    """
+    if os.path.isfile(basename + WEIGHTS_EXT):
+        return basename + WEIGHTS_EXT
+    return basename + '.npy'
+
+
+def load_weights(fileName, shape=None):
+    """ Memory-map a weight file and return a dict with the keys 'shape',
+        'i', 'j' and 'w'. For the dense layout 'i' and 'j' are None and 'w'
+        is the (n_src, n_tgt) float32 matrix; otherwise 'i' and 'j' are int32
+        and 'w' has one entry per stored synapse (float32, or float64 for
+        legacy files). The arrays are read-only views of the file.
+        fileName: Path of a '.weights' file or of a legacy '.npy' file.
+        shape: Expected (n_src, n_tgt); required for legacy files, which
+            carry no shape.
+    """
+    if fileName.endswith('.npy'):
+        readout = np.load(fileName, mmap_mode='r')
+        if readout.shape == (0,):
+            readout = np.zeros((0, 3))
+        if readout.ndim != 2 or readout.shape[1] != 3:
+            raise ValueError('{} is not an (N, 3) array of (i, j, w) rows'.format(fileName))
+        if shape is None:
+            raise ValueError('The shape of legacy weight file {} must be given'.format(fileName))
+        return {'shape': tuple(shape), 'i': readout[:, 0].astype(np.int32),
+                'j': readout[:, 1].astype(np.int32), 'w': readout[:, 2]}
+
+    with open(fileName, mode='rb') as f:
+        magic, version, layout, n_src, n_tgt, nnz = WEIGHTS_HEADER.unpack(f.read(WEIGHTS_HEADER.size))
+    if magic != WEIGHTS_MAGIC or version != WEIGHTS_VERSION:
+        raise ValueError('{} is not a version {} weight file'.format(fileName, WEIGHTS_VERSION))
+    if shape is not None and tuple(shape) != (n_src, n_tgt):
+        raise ValueError('{} holds a {}x{} connection, expected {}x{}'.format(
+            fileName, n_src, n_tgt, shape[0], shape[1]))
+    def view(k, dtype, array_shape):
+        if nnz == 0:
+            return np.zeros(array_shape, dtype=dtype)
+        return np.memmap(fileName, dtype=dtype, mode='r', shape=array_shape,
+                         offset=WEIGHTS_HEADER.size + 4 * k * nnz)
+    if layout == LAYOUT_DENSE:
+        return {'shape': (n_src, n_tgt), 'i': None, 'j': None, 'w': view(0, '<f4', (n_src, n_tgt))}
+    return {'shape': (n_src, n_tgt), 'i': view(0, '<i4', (nnz,)),
+            'j': view(1, '<i4', (nnz,)), 'w': view(2, '<f4', (nnz,))}
+
+
+def load_dense_weights(fileName, shape=None):
+    """ Load a weight file as a dense (n_src, n_tgt) float64 matrix, with 0
+        for pairs that are not stored.
+        fileName: Path of a '.weights' file or of a legacy '.npy' file.
+        shape: Expected (n_src, n_tgt), as for load_weights.
+    """
+    weights = load_weights(fileName, shape)
+    if weights['i'] is None:
+        return np.array(weights['w'], dtype=np.float64)
+    matrix = np.zeros(weights['shape'])
+    matrix[np.asarray(weights['i']), np.asarray(weights['j'])] = weights['w']
+    return matrix
@@ -3,47 +3,166 @@ A variety of functions for managing the loading of MNIST data.
 '''
 
 import os
+import gzip
 import pickle
 import numpy as np
-from struct import unpack
-from tqdm import tqdm
+from struct import Struct, unpack
+
+# IDX magic numbers: two zero bytes, the data type (0x08 = unsigned byte)
+# and the number of dimensions.
+IDX_IMAGES_MAGIC = 0x00000803
+IDX_LABELS_MAGIC = 0x00000801
+
+# The dataset store is one flat file: a small header, the raw uint8 image
+# block and the uint8 label block. It is opened with np.memmap, so loading is
+# free and concurrent processes share one page-cache copy of the data.
+STORE_MAGIC = b'MNST'
+STORE_VERSION = 1
+STORE_HEADER = Struct('<4sIIII')  # magic, version, number of images, rows, cols
+STORE_DATA_OFFSET = 64
+
+# Payloads are read in chunks of this size, so gzipped input is decompressed
+# straight into the target arrays without a full copy in memory or on disk.
+READ_CHUNK_SIZE = 1 << 24
+
+
+def read_idx_header(f, magic):
+    """ Read and validate the header of an IDX file and return its dimensions.
+        f: File object positioned at the start of the IDX file.
+        magic: Expected magic number (IDX_IMAGES_MAGIC or IDX_LABELS_MAGIC).
+    """
+    found_magic = unpack('>I', f.read(4))[0]
+    if found_magic != magic:
+        raise ValueError('Bad IDX magic number {:#010x} in {} (expected {:#010x})'.format(
+            found_magic, getattr(f, 'name', 'input'), magic))
+    num_dims = magic & 0xff
+    return unpack('>' + 'I' * num_dims, f.read(4 * num_dims))
+
+
+def read_idx_data(f, out):
+    """ Fill the uint8 array `out` with the payload of an IDX file.
+        f: File object positioned right after the IDX header.
+        out: Contiguous uint8 array with the size given by the header.
+    """
+    buf = memoryview(out).cast('B')
+    num_read = 0
+    while num_read < len(buf):
+        n = f.readinto(buf[num_read:num_read + READ_CHUNK_SIZE])
+        if not n:
+            raise ValueError('Truncated IDX file {}: expected {} bytes, got {}'.format(
+                getattr(f, 'name', 'input'), out.nbytes, num_read))
+        num_read += n
+    return out
+
+
+def open_idx(MNIST_data_path, name):
+    """ Open an IDX file for reading, either extracted or gzipped.
+        MNIST_data_path: Directory containing the MNIST files.
+        name: File name as distributed, e.g. 'train-images-idx3-ubyte'.
+            The extracted name with a dot ('train-images.idx3-ubyte') and
+            the '.gz' download of either name are accepted as well.
+    """
+    dotted = name.replace('-idx', '.idx')
+    for candidate in (dotted, name, dotted + '.gz', name + '.gz'):
+        path = os.path.join(MNIST_data_path, candidate)
+        if os.path.isfile(path):
+            if path.endswith('.gz'):
+                return gzip.open(path, mode='rb')
+            return open(path, mode='rb')
+    raise FileNotFoundError('Could not find {} (or {}, or a .gz of either) in {}'.format(
+        name, dotted, MNIST_data_path))
+
+
+def _store_layout(N, rows, cols):
+    """ Return the (offset, shape) of the image and label blocks of a store.
+    """
+    x_shape = (N, rows, cols)
+    y_offset = STORE_DATA_OFFSET + N * rows * cols
+    return (STORE_DATA_OFFSET, x_shape), (y_offset, (N, 1))
+
+
+def _create_store(storename, N, rows, cols):
+    """ Create a temporary store file next to `storename` and return its path
+        together with writable memory-mapped image and label arrays.
+    """
+    (x_offset, x_shape), (y_offset, y_shape) = _store_layout(N, rows, cols)
+    tmpname = '{}.{}.tmp'.format(storename, os.getpid())
+    with open(tmpname, mode='wb') as f:
+        f.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, N, rows, cols))
+        f.truncate(y_offset + N)
+    x = np.memmap(tmpname, dtype=np.uint8, mode='r+', offset=x_offset, shape=x_shape)
+    y = np.memmap(tmpname, dtype=np.uint8, mode='r+', offset=y_offset, shape=y_shape)
+    return tmpname, x, y
+
+
+def _commit_store(tmpname, storename, x, y):
+    """ Flush a store created by _create_store and atomically move it in place.
+    """
+    x.flush()
+    y.flush()
+    del x, y
+    os.replace(tmpname, storename)
+
+
+def write_store(storename, data):
+    """ Write a dataset dict with keys 'x', 'y', 'rows' and 'cols' to a store.
+        storename: Path of the store file.
+        data: Dict as returned by get_labeled_data.
+    """
+    N = len(data['x'])
+    tmpname, x, y = _create_store(storename, N, data['rows'], data['cols'])
+    x[:] = data['x']
+    y[:] = np.reshape(data['y'], (N, 1))
+    _commit_store(tmpname, storename, x, y)
+
+
+def open_store(storename):
+    """ Open a store read-only and return the same dict as get_labeled_data,
+        with 'x' and 'y' as zero-copy memory-mapped arrays.
+        storename: Path of the store file.
+    """
+    with open(storename, mode='rb') as f:
+        magic, version, N, rows, cols = STORE_HEADER.unpack(f.read(STORE_HEADER.size))
+    if magic != STORE_MAGIC or version != STORE_VERSION:
+        raise ValueError('{} is not a version {} MNIST store'.format(storename, STORE_VERSION))
+    (x_offset, x_shape), (y_offset, y_shape) = _store_layout(N, rows, cols)
+    x = np.memmap(storename, dtype=np.uint8, mode='r', offset=x_offset, shape=x_shape)
+    y = np.memmap(storename, dtype=np.uint8, mode='r', offset=y_offset, shape=y_shape)
+    return {'x': x, 'y': y, 'rows': rows, 'cols': cols}
+
 
 def get_labeled_data(picklename, bTrain = True, MNIST_data_path='./mnist'):
     """ Read input-vector (image) and target class (label, 0-9) and return
-        it as list of tuples.
-        picklename: Path to the output pickle file.
+        it as a dict of memory-mapped arrays.
+        picklename: Path of the dataset cache, without extension. The store
+            is kept in '<picklename>.mnist'; an existing '<picklename>.pickle'
+            from older versions is converted on first use.
         bTrain: True if training data, else False for test data.
-        MNIST_data_path: Directory containing the MNIST files.
+        MNIST_data_path: Directory containing the MNIST files, extracted or
+            as the downloaded '.gz' files.
     """
+    storename = '{}.mnist'.format(picklename)
+    if os.path.isfile(storename):
+        return open_store(storename)
     if os.path.isfile('{}.pickle'.format(picklename)):
-        data = pickle.load(open('{}.pickle'.format(picklename), mode='rb'))
-    else:
-        # Open the images with gzip in read binary mode
-        if bTrain:
-            images = open(os.path.join(MNIST_data_path, 'train-images.idx3-ubyte'), mode='rb')
-            labels = open(os.path.join(MNIST_data_path, 'train-labels.idx1-ubyte'), mode='rb')
-        else:
-            images = open(os.path.join(MNIST_data_path, 't10k-images.idx3-ubyte'), mode='rb')
-            labels = open(os.path.join(MNIST_data_path, 't10k-labels.idx1-ubyte'), mode='rb')
-        # Get metadata for images
-        images.read(4)  # skip the magic_number
-        number_of_images = unpack('>I', images.read(4))[0]
-        rows = unpack('>I', images.read(4))[0]
-        cols = unpack('>I', images.read(4))[0]
-        # Get metadata for labels
-        labels.read(4)  # skip the magic_number
-        N = unpack('>I', labels.read(4))[0]
+        write_store(storename, pickle.load(open('{}.pickle'.format(picklename), mode='rb')))
+        return open_store(storename)
 
+    prefix = 'train' if bTrain else 't10k'
+    print('Unpacking {} images...'.format('training' if bTrain else 'test'))
+    with open_idx(MNIST_data_path, prefix + '-images-idx3-ubyte') as images, \
+            open_idx(MNIST_data_path, prefix + '-labels-idx1-ubyte') as labels:
+        number_of_images, rows, cols = read_idx_header(images, IDX_IMAGES_MAGIC)
+        N, = read_idx_header(labels, IDX_LABELS_MAGIC)
         if number_of_images != N:
             raise ValueError('The number of labels did not match the number of images')
-        # Get the data
-        x = np.zeros((N, rows, cols), dtype=np.uint8)  # Initialize numpy array
-        y = np.zeros((N, 1), dtype=np.uint8)  # Initialize numpy array
-        print('Unpacking {} images...'.format('training' if bTrain else 'test'))
-        for i in tqdm(range(N)):
-            x[i] = [[unpack('>B', images.read(1))[0] for unused_col in range(cols)]  for unused_row in range(rows) ]
-            y[i] = unpack('>B', labels.read(1))[0]
-
-        data = {'x': x, 'y': y, 'rows': rows, 'cols': cols}
-        pickle.dump(data, open("{}.pickle".format(picklename), "wb"))
-    return data
\ No newline at end of file
+        tmpname, x, y = _create_store(storename, N, rows, cols)
+        try:
+            read_idx_data(images, x)
+            read_idx_data(labels, y)
+        except Exception:
+            del x, y
+            os.remove(tmpname)
+            raise
+    _commit_store(tmpname, storename, x, y)
+    return open_store(storename)
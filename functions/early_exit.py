@@ -0,0 +1,107 @@
+'''
+Early exit of test presentations and its accuracy-latency trade-off.
+
+With early_exit_margin set, the main script presents each test example in
+steps of early_exit_interval. After every step it computes the rate of
+every class, the mean spike count of the neurons assigned to it, as in
+get_recognized_number_ranking. The presentation ends as soon as the
+leading class is ahead of the second one by early_exit_margin, relative
+to its rate, and Ae has spiked at least early_exit_min_spikes times.
+
+The neurons are assigned to classes beforehand, from a test-mode run on
+training examples:
+
+    python -m functions.early_exit --assign activity/resultPopVecs0-10000.npy activity/inputNumbers0-10000.npy
+
+The class rates after every step are written to activity/earlyExit<N>.npz.
+A run with early_exit_margin = np.inf never exits early and records whole
+presentations, from which the accuracy and mean presentation time of any
+margin follow:
+
+    python -m functions.early_exit --curve activity/earlyExit10000.npz activity/inputNumbers10000.npy
+'''
+
+import argparse
+import numpy as np
+
+
+def get_class_rates(assignments, spike_counts):
+    """ Return the mean spike count of the neurons assigned to every class,
+        0 for a class without neurons. spike_counts has the neurons on its
+        last axis, which is replaced by one of length 10.
+    """
+    spike_counts = np.asarray(spike_counts)
+    class_rates = np.zeros(spike_counts.shape[:-1] + (10,))
+    for number in range(10):
+        if np.any(assignments == number):
+            class_rates[..., number] = np.mean(spike_counts[..., assignments == number], axis=-1)
+    return class_rates
+
+
+def is_decided(class_rates, spike_totals, margin, min_spikes):
+    """ True where the leading class is ahead of the second one by margin,
+        relative to its rate, with at least min_spikes spikes in total. An
+        infinite margin is never reached.
+    """
+    ranked = np.sort(class_rates, axis=-1)
+    top, second = ranked[..., -1], ranked[..., -2]
+    enough_spikes = np.asarray(spike_totals) >= min_spikes
+    if np.isinf(margin):
+        return np.zeros(np.broadcast(enough_spikes, top).shape, dtype=bool)
+    return enough_spikes & (top > 0) & (top - second >= margin * top)
+
+
+def get_decisions(class_rates):
+    """ The recognized class, as get_recognized_number_ranking does it.
+    """
+    return np.argsort(class_rates, axis=-1)[..., ::-1][..., 0]
+
+
+def latency_curve(class_rates, spike_totals, labels, margins, min_spikes, interval):
+    """ Accuracy and mean presentation time of the early exit for every
+        margin, from the class rates and spike totals after every step of
+        whole presentations, shaped (examples, steps, 10) and (examples,
+        steps). A presentation that is never decided runs all steps.
+        Returns two arrays of the length of margins.
+    """
+    num_examples, num_steps = np.shape(spike_totals)
+    accuracy = np.zeros(len(margins))
+    latency = np.zeros(len(margins))
+    for k, margin in enumerate(margins):
+        decided = is_decided(class_rates, spike_totals, margin, min_spikes)
+        decided[:, -1] = True
+        exit_steps = np.argmax(decided, axis=1)
+        decisions = get_decisions(class_rates[np.arange(num_examples), exit_steps])
+        accuracy[k] = np.mean(decisions == np.asarray(labels))
+        latency[k] = np.mean(exit_steps + 1) * interval
+    return accuracy, latency
+
+
+if __name__ == '__main__':
+    from functions.sweep import get_assignments
+
+    parser = argparse.ArgumentParser(description='Assign the neurons for the early exit or report its latency curve.')
+    parser.add_argument('--assign', nargs=2, metavar=('RESULTS', 'NUMBERS'),
+                        help='resultPopVecs and inputNumbers of a test-mode run on training examples')
+    parser.add_argument('--assignments', default='./activity/assignments.npy',
+                        help='assignments file (default: ./activity/assignments.npy)')
+    parser.add_argument('--curve', nargs=2, metavar=('EARLY_EXIT', 'NUMBERS'),
+                        help='earlyExit file and inputNumbers of a run with early_exit_margin = np.inf')
+    parser.add_argument('--margins', type=float, nargs='+', default=[0., 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, np.inf],
+                        help='relative margins of the latency curve')
+    parser.add_argument('--min-spikes', type=int, default=10, help='spikes needed for an exit (default: 10)')
+    args = parser.parse_args()
+
+    if args.assign is not None:
+        assignments = get_assignments(np.load(args.assign[0]), np.load(args.assign[1]))
+        np.save(args.assignments, assignments)
+        print('neurons per class:', np.bincount(assignments[assignments >= 0], minlength=10))
+    if args.curve is not None:
+        recorded = np.load(args.curve[0])
+        if np.any(np.isnan(recorded['spike_totals'])):
+            raise ValueError(args.curve[0] + ' has presentations that exited early, record it with early_exit_margin = np.inf')
+        accuracy, latency = latency_curve(recorded['class_rates'], recorded['spike_totals'], np.load(args.curve[1]),
+                                          args.margins, args.min_spikes, float(recorded['interval']))
+        print('margin   accuracy   presentation time (s)')
+        for margin, a, t in zip(args.margins, accuracy, latency):
+            print('{:<8} {:<10.4f} {:.4f}'.format(margin, a, t))
@@ -0,0 +1,326 @@
+'''
+A NumPy inference engine for a trained network.
+
+In test mode STDP is off and theta is fixed, so the network only carries its
+fast state (potentials, conductances, timers) from one presentation to the
+next. The engine simulates batch_size independent copies of the network at
+once, every variable held in a (batch, neuron) array, and feeds each copy
+its own sequence of examples. It implements the model of the main script:
+conductance-based leaky integrate-and-fire neurons integrated with the Euler
+method, Poisson input through the XeAe connection with uniform random
+delays, the timer-gated adaptive threshold of the excitatory neurons and the
+repeated presentation, one intensity step higher, of examples that drew
+fewer than 5 spikes.
+'''
+
+import os
+import time
+import argparse
+import numpy as np
+
+from functions.spikes import encode_poisson
+from functions.connections import get_weights_file, load_dense_weights
+
+# parameters of the main script, in SI units
+N_INPUT = 784
+V_REST_E = -65e-3
+V_REST_I = -60e-3
+V_RESET_E = -65e-3
+V_RESET_I = -45e-3
+V_THRESH_E = -52e-3
+V_THRESH_I = -40e-3
+V_INIT_OFFSET = -40e-3 # initial potential relative to the resting potential
+E_INH_E = -100e-3
+E_INH_I = -85e-3
+THETA_OFFSET = 20e-3
+REFRAC_E = 5e-3
+REFRAC_I = 2e-3
+TC_V_E = 100e-3
+TC_V_I = 10e-3
+TC_GE = 1e-3
+TC_GI = 2e-3
+TIMER_RATE = 0.1
+MAX_INPUT_DELAY = 10e-3
+MIN_SPIKES = 5
+
+
+class InferenceEngine(object):
+    """ Batched simulation of a trained network without plasticity.
+        input_weights: (n_input, n_e) weights of XeAe.
+        ei_weights: (n_e, n_i) weights of AeAi.
+        ie_weights: (n_i, n_e) weights of AiAe.
+        theta: Adaptive threshold of the excitatory neurons in volt.
+        dt: Time step in seconds.
+        seed: Seed of the input delays and spike trains.
+    """
+
+    def __init__(self, input_weights, ei_weights, ie_weights, theta, dt=0.1e-3, seed=None):
+        self.w_input = np.asarray(input_weights, dtype=np.float64)
+        self.w_ei = np.asarray(ei_weights, dtype=np.float64)
+        self.w_ie = np.asarray(ie_weights, dtype=np.float64)
+        self.v_thresh_e = np.asarray(theta, dtype=np.float64) - THETA_OFFSET + V_THRESH_E
+        self.n_input, self.n_e = self.w_input.shape
+        self.n_i = self.w_ei.shape[1]
+        self.dt = dt
+        self.rng = np.random.default_rng(seed)
+        # the delays of the input synapses in time steps, drawn like
+        # 'minDelay + rand() * deltaDelay' and rounded like Brian2's spike queue
+        delays = np.round(self.rng.random(self.w_input.shape) * MAX_INPUT_DELAY / dt).astype(np.int64)
+        self.num_delays = int(round(MAX_INPUT_DELAY / dt)) + 1
+        # the synapses of every input neuron sorted by delay: the synapses
+        # with delay d of input i are the entries delay_ptr[i, d] to
+        # delay_ptr[i, d + 1] of row i of delay_targets and delay_weights
+        order = np.argsort(delays, axis=1, kind='stable')
+        self.delay_targets = order
+        self.delay_weights = np.take_along_axis(self.w_input, order, axis=1)
+        self.delay_ptr = np.zeros((self.n_input, self.num_delays + 1), dtype=np.int64)
+        self.delay_ptr[:, 1:] = np.cumsum([np.bincount(d, minlength=self.num_delays) for d in delays], axis=1)
+        self.refrac_e_steps = int(round(REFRAC_E / dt))
+        self.refrac_i_steps = int(round(REFRAC_I / dt))
+        # half a timer increment above REFRAC_E, as in functions/model.py
+        self.timer_threshold = REFRAC_E + 0.5 * TIMER_RATE * dt
+
+    @classmethod
+    def from_files(cls, data_path='./', ending='', **kwargs):
+        """ Load the trained XeAe weights and theta from weights/ and the fixed
+            AeAi and AiAe weights from random/, as the test mode does.
+        """
+        weight_path = data_path + 'weights/'
+        theta = np.load(weight_path + 'theta_A' + ending + '.npy')
+        n_e = n_i = len(theta)
+        return cls(load_dense_weights(get_weights_file(weight_path + 'XeAe' + ending), (N_INPUT, n_e)),
+                   load_dense_weights(get_weights_file(data_path + 'random/AeAi' + ending), (n_e, n_i)),
+                   load_dense_weights(get_weights_file(data_path + 'random/AiAe' + ending), (n_i, n_e)),
+                   theta, **kwargs)
+
+    def reset(self, batch_size):
+        """ Put batch_size copies of the network in their initial state.
+        """
+        shape_e, shape_i = (batch_size, self.n_e), (batch_size, self.n_i)
+        self.v_e = np.full(shape_e, V_REST_E + V_INIT_OFFSET)
+        self.ge_e = np.zeros(shape_e)
+        self.gi_e = np.zeros(shape_e)
+        self.timer_e = np.zeros(shape_e)
+        self.lastspike_e = np.full(shape_e, -10**9, dtype=np.int64)
+        self.v_i = np.full(shape_i, V_REST_I + V_INIT_OFFSET)
+        self.ge_i = np.zeros(shape_i)
+        self.gi_i = np.zeros(shape_i)
+        self.lastspike_i = np.full(shape_i, -10**9, dtype=np.int64)
+        # buffers for the in-place arithmetic of _step
+        self._buffers_e = [np.empty(shape_e), np.empty(shape_e), np.empty(shape_e, dtype=bool),
+                           np.empty(shape_e, dtype=bool), np.empty(shape_e, dtype=bool)]
+        self._buffers_i = [np.empty(shape_i), np.empty(shape_i), np.empty(shape_i, dtype=bool),
+                           np.empty(shape_i, dtype=bool)]
+        self.step = 0
+
+    def present(self, rates, num_input_steps, num_rest_steps):
+        """ Present one example to every copy for num_input_steps, with the
+            input rates in Hz of each copy in the rows of rates, followed by
+            num_rest_steps without input. Returns the (batch, n_e) spike
+            counts of the presentation.
+        """
+        batch_size = len(rates)
+        trains = [encode_poisson(r, num_input_steps, self.dt, self.rng) for r in rates]
+        lanes = np.repeat(np.arange(batch_size), [len(indices) for indices, steps in trains])
+        indices = np.concatenate([indices for indices, steps in trains]).astype(np.int64)
+        steps = np.concatenate([steps for indices, steps in trains]).astype(np.int64)
+        order = np.argsort(steps, kind='stable')
+        lanes, indices, steps = lanes[order], indices[order], steps[order]
+        bounds = np.searchsorted(steps, np.arange(num_input_steps + 1))
+
+        counts = np.zeros((batch_size, self.n_e))
+        for k in range(num_input_steps + num_rest_steps):
+            spikes_e = self._step(self._get_input(k, lanes, indices, steps, bounds, batch_size))
+            if k < num_input_steps:
+                counts += spikes_e
+        return counts
+
+    def _get_input(self, k, lanes, indices, steps, bounds, batch_size):
+        # the input conductance that arrives at step k of a presentation:
+        # the weights of the synapses whose delay equals the age of a spike
+        num_input_steps = len(bounds) - 1
+        if k - self.num_delays + 1 >= num_input_steps:
+            return 0.
+        first = bounds[max(k - self.num_delays + 1, 0)]
+        last = bounds[min(k + 1, num_input_steps)]
+        if last == first:
+            return 0.
+        i = indices[first:last]
+        age = k - steps[first:last]
+        start = self.delay_ptr[i, age]
+        length = self.delay_ptr[i, age + 1] - start
+        total = int(length.sum())
+        synapses = np.repeat(i * self.n_e + start - np.cumsum(length) + length, length) + np.arange(total)
+        targets = self.delay_targets.reshape(-1)[synapses] + np.repeat(lanes[first:last] * self.n_e, length)
+        return np.bincount(targets, weights=self.delay_weights.reshape(-1)[synapses],
+                           minlength=batch_size * self.n_e).reshape((batch_size, self.n_e))
+
+    def _update(self, buffers, v, ge, gi, lastspike, v_rest, e_inh, tc_v, refrac_steps):
+        # Euler step of a population, in place; returns not_refractory
+        t, u, not_refractory = buffers[:3]
+        np.greater_equal(self.step - lastspike, refrac_steps, out=not_refractory)
+        # dv = ((v_rest - v) - ge * v + gi * (e_inh - v)) * dt / tc_v
+        np.add(ge, gi, out=t)
+        t += 1
+        t *= v
+        np.multiply(gi, e_inh, out=u)
+        u += v_rest
+        u -= t
+        u *= self.dt / tc_v
+        u *= not_refractory
+        v += u
+        ge *= 1 - self.dt / TC_GE
+        gi *= 1 - self.dt / TC_GI
+        return not_refractory
+
+    def _step(self, input_arrivals):
+        # one time step in the order of Brian2's schedule: state update,
+        # thresholds, synaptic transmission, resets
+        not_refractory_e = self._update(self._buffers_e, self.v_e, self.ge_e, self.gi_e, self.lastspike_e,
+                                        V_REST_E, E_INH_E, TC_V_E, self.refrac_e_steps)
+        not_refractory_i = self._update(self._buffers_i, self.v_i, self.ge_i, self.gi_i, self.lastspike_i,
+                                        V_REST_I, E_INH_I, TC_V_I, self.refrac_i_steps)
+        self.timer_e += TIMER_RATE * self.dt
+
+        spikes_e, timer_over = self._buffers_e[3:]
+        np.greater(self.v_e, self.v_thresh_e, out=spikes_e)
+        spikes_e &= not_refractory_e
+        spikes_e &= np.greater(self.timer_e, self.timer_threshold, out=timer_over)
+        spikes_i = np.greater(self.v_i, V_THRESH_I, out=self._buffers_i[3])
+        spikes_i &= not_refractory_i
+
+        self.ge_e += input_arrivals
+        if spikes_e.any():
+            lanes, neurons = np.nonzero(spikes_e)
+            np.add.at(self.ge_i, lanes, self.w_ei[neurons])
+            self.v_e[spikes_e] = V_RESET_E
+            self.timer_e[spikes_e] = 0
+            self.lastspike_e[spikes_e] = self.step
+        if spikes_i.any():
+            lanes, neurons = np.nonzero(spikes_i)
+            np.add.at(self.gi_e, lanes, self.w_ie[neurons])
+            self.v_i[spikes_i] = V_RESET_I
+            self.lastspike_i[spikes_i] = self.step
+        self.step += 1
+        return spikes_e
+
+    def run(self, images, intensities, batch_size=100, example_time=0.35, resting_time=0.15, report=None):
+        """ Present every image until it draws at least 5 spikes, raising its
+            intensity by 1 after every failed presentation. Each copy of the
+            network takes the next image as soon as its current one succeeded.
+            images: uint8 array of shape (N, rows, cols).
+            intensities: Starting input intensity, one for all images or one
+                per image; pixel p fires at p / 8 * intensity Hz.
+            report: Function called with the number of finished images after
+                every presentation, or None.
+            Returns the (N, n_e) spike counts and the (N,) retry counts.
+        """
+        N = len(images)
+        images = np.asarray(images).reshape((N, -1))
+        intensities = np.broadcast_to(np.asarray(intensities, dtype=np.float64), (N,))
+        num_input_steps = int(round(example_time / self.dt))
+        num_rest_steps = int(round(resting_time / self.dt))
+        if num_rest_steps < self.num_delays - 1:
+            raise ValueError('The rest must outlast the largest input delay of {} s'.format(MAX_INPUT_DELAY))
+        spike_counts = np.zeros((N, self.n_e))
+        retry_counts = np.zeros(N, dtype=int)
+        batch_size = min(batch_size, N)
+        self.reset(batch_size)
+        # In the main loop every example but the first follows a rest, after
+        # which the timers of all neurons have run out. Starting the copies
+        # with a rest keeps their first examples from a synchronous volley of
+        # the neurons the timers held back.
+        self.present(np.zeros((batch_size, self.n_input)), 0, num_rest_steps)
+        lane_example = np.arange(batch_size)
+        lane_intensity = intensities[:batch_size].copy()
+        next_example = batch_size
+        finished = 0
+        while (lane_example >= 0).any():
+            active = lane_example >= 0
+            rates = np.zeros((batch_size, self.n_input))
+            rates[active] = images[lane_example[active]] / 8. * lane_intensity[active, np.newaxis]
+            counts = self.present(rates, num_input_steps, num_rest_steps)
+            for lane in np.flatnonzero(active):
+                example = lane_example[lane]
+                if np.sum(counts[lane]) < MIN_SPIKES:
+                    retry_counts[example] += 1
+                    lane_intensity[lane] += 1
+                    continue
+                spike_counts[example] = counts[lane]
+                finished += 1
+                if next_example < N:
+                    lane_example[lane] = next_example
+                    lane_intensity[lane] = intensities[next_example]
+                    next_example += 1
+                else:
+                    lane_example[lane] = -1
+            if report is not None:
+                report(finished)
+        return spike_counts, retry_counts
+
+
+def compare_spike_counts(spike_counts, reference):
+    """ Compare the spike counts of two runs on the same examples, e.g. the
+        engine and the Brian2 test mode. The spike trains differ, so the
+        comparison uses statistics: the mean and standard deviation of the
+        spikes per example, the correlation of the spikes per example and
+        the correlation of the mean count of every neuron.
+    """
+    totals = np.sum(spike_counts, axis=1)
+    reference_totals = np.sum(reference, axis=1)
+    return {'mean_spikes': totals.mean(), 'reference_mean_spikes': reference_totals.mean(),
+            'std_spikes': totals.std(), 'reference_std_spikes': reference_totals.std(),
+            'relative_difference': abs(totals.mean() - reference_totals.mean()) / reference_totals.mean(),
+            'example_correlation': np.corrcoef(totals, reference_totals)[0, 1],
+            'neuron_correlation': np.corrcoef(np.mean(spike_counts, axis=0), np.mean(reference, axis=0))[0, 1]}
+
+
+if __name__ == '__main__':
+    from functions.data import get_labeled_data
+    from functions.intensity import IntensityPredictor
+
+    parser = argparse.ArgumentParser(description='Test a trained network with the NumPy inference engine.')
+    parser.add_argument('--num-examples', type=int, default=10000, help='number of examples (default: 10000)')
+    parser.add_argument('--training', action='store_true', help='present the training set instead of the test set')
+    parser.add_argument('--batch-size', type=int, default=100, help='network copies simulated at once (default: 100)')
+    parser.add_argument('--intensity', type=float, default=4., help='starting input intensity (default: 4)')
+    parser.add_argument('--predictor', default=None, help='intensity predictor file, see functions/intensity.py')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    parser.add_argument('--data-path', default='./', help='directory with weights/, random/ and activity/')
+    parser.add_argument('--mnist-path', default='./mnist/', help='location of the MNIST data')
+    parser.add_argument('--compare', default=None, help='resultPopVecs file of a Brian2 run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='largest accepted relative difference of the mean spikes per example (default: 0.1)')
+    parser.add_argument('--suffix', default='',
+                        help='appended to the names of the result files, e.g. _engine for resultPopVecs<N>_engine.npy')
+    args = parser.parse_args()
+
+    ending = str(args.num_examples) + args.suffix
+    if args.compare is not None and os.path.abspath(args.compare) == \
+            os.path.abspath(args.data_path + 'activity/resultPopVecs' + ending + '.npy'):
+        raise ValueError(args.compare + ' would be overwritten by the results, choose a --suffix')
+    dataset_name = 'training' if args.training else 'testing'
+    data = get_labeled_data(args.mnist_path + dataset_name, bTrain = args.training, MNIST_data_path = args.mnist_path)
+    examples = np.arange(args.num_examples) % len(data['x'])
+    images = data['x'][examples]
+    intensities = args.intensity
+    if args.predictor is not None:
+        predictor = IntensityPredictor.load(args.predictor)
+        intensities = args.intensity + predictor.predict_steps(images)
+    engine = InferenceEngine.from_files(args.data_path, seed=args.seed)
+
+    start = time.time()
+    def report(finished):
+        print('runs done:', finished, 'of', args.num_examples, 'after', round(time.time() - start, 1), 's')
+    spike_counts, retry_counts = engine.run(images, intensities, args.batch_size, report=report)
+    print('time needed:', time.time() - start, 's,', (time.time() - start) / args.num_examples, 's per example')
+    print('repeated presentations:', np.sum(retry_counts), 'retry rate:', np.mean(retry_counts))
+
+    if args.compare is not None:
+        statistics = compare_spike_counts(spike_counts, np.load(args.compare))
+        for key, value in statistics.items():
+            print(key + ':', value)
+        print('within tolerance:', statistics['relative_difference'] <= args.tolerance)
+    np.save(args.data_path + 'activity/resultPopVecs' + ending, spike_counts)
+    np.save(args.data_path + 'activity/inputNumbers' + ending, data['y'][examples, 0].astype(int))
+    np.save(args.data_path + 'activity/retryCounts' + ending, retry_counts)
@@ -0,0 +1,132 @@
+'''
+Prediction of the input intensity an example needs to make the network spike.
+
+The main loop presents an example again, one intensity step higher, as long
+as it draws fewer than 5 spikes. The input drive of an example is about
+proportional to its intensity times its ink, the sum of its pixel values, so
+faint and thin digits need more retries. An IntensityPredictor is calibrated
+on the retry history of an earlier run (activity/retryCounts<N>.npy): it
+sorts the images into bins of equal size by ink and, for every bin, learns
+the number of intensity steps that lets a given fraction of its examples
+succeed at the first presentation. Starting an example that many steps
+higher removes the same number of retries.
+'''
+
+import re
+import argparse
+import numpy as np
+
+from functions.checkpoint import write_atomic
+
+
+def image_ink(images):
+    """ Return the ink of every image: the sum of its pixel values.
+        images: uint8 array of shape (N, rows, cols) or (N, pixels).
+    """
+    images = np.asarray(images)
+    return images.reshape((len(images), -1)).sum(axis=1, dtype=np.int64).astype(np.float64)
+
+
+class IntensityPredictor(object):
+    """ Starting input intensity of an example as a step function of its ink.
+        edges: Inner bin edges of the ink, increasing.
+        steps: Intensity steps added to start_intensity in each of the
+            len(edges) + 1 bins.
+        start_intensity: Intensity of the run the predictor was calibrated on.
+        baseline_retries: Mean retries per example of that run.
+    """
+
+    def __init__(self, edges, steps, start_intensity, baseline_retries):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.steps = np.asarray(steps, dtype=np.int64)
+        self.start_intensity = float(start_intensity)
+        self.baseline_retries = float(baseline_retries)
+
+    @classmethod
+    def fit(cls, images, retry_counts, start_intensity, num_bins=20, coverage=0.8):
+        """ Calibrate a predictor on a retry history.
+            images: Images of the examples of the history.
+            retry_counts: Retries of every example, from a run that started
+                every example at start_intensity.
+            start_intensity: Starting intensity of that run.
+            num_bins: Number of ink bins.
+            coverage: Fraction of the examples of a bin that should succeed
+                at the first presentation.
+        """
+        ink = image_ink(images)
+        retry_counts = np.asarray(retry_counts, dtype=np.int64)
+        if len(ink) != len(retry_counts):
+            raise ValueError('{} images but {} retry counts'.format(len(ink), len(retry_counts)))
+        edges = np.unique(np.quantile(ink, np.linspace(0, 1, num_bins + 1)[1:-1]))
+        bins = np.searchsorted(edges, ink, side='right')
+        steps = np.zeros(len(edges) + 1, dtype=np.int64)
+        for b in np.unique(bins):
+            steps[b] = np.quantile(retry_counts[bins == b], coverage, method='higher')
+        # fainter images never need fewer steps than brighter ones
+        steps = np.maximum.accumulate(steps[::-1])[::-1]
+        return cls(edges, steps, start_intensity, retry_counts.mean())
+
+    def predict_steps(self, images):
+        """ Return the intensity steps added for every image.
+        """
+        return self.steps[np.searchsorted(self.edges, image_ink(images), side='right')]
+
+    def predict(self, images):
+        """ Return the starting intensity of every image.
+        """
+        return self.start_intensity + self.predict_steps(images)
+
+    def remaining_retries(self, images, retry_counts):
+        """ Return the retries of a history that would remain with the
+            predicted starting intensities.
+        """
+        return np.maximum(np.asarray(retry_counts) - self.predict_steps(images), 0)
+
+    def save(self, fileName):
+        """ Atomically save the predictor in .npz format to fileName.
+        """
+        write_atomic(fileName, lambda f: np.savez(f, edges=self.edges, steps=self.steps,
+                                                  start_intensity=self.start_intensity,
+                                                  baseline_retries=self.baseline_retries))
+
+    @classmethod
+    def load(cls, fileName):
+        """ Load a predictor written by save.
+        """
+        with np.load(fileName) as f:
+            return cls(f['edges'], f['steps'], f['start_intensity'], f['baseline_retries'])
+
+
+if __name__ == '__main__':
+    from functions.data import get_labeled_data
+
+    parser = argparse.ArgumentParser(description='Calibrate the starting input intensity on a retry history.')
+    parser.add_argument('history', help='retry counts of a run, e.g. activity/retryCounts10000.npy')
+    parser.add_argument('--testing', action='store_true', help='the history is from the test set')
+    parser.add_argument('--first-example', type=int, default=0,
+                        help='first example of the history, e.g. 2000 for retryCounts2000-4000.npy (default: 0)')
+    parser.add_argument('--intensity', type=float, default=4., help='starting intensity of the run (default: 4)')
+    parser.add_argument('--bins', type=int, default=20, help='number of ink bins (default: 20)')
+    parser.add_argument('--coverage', type=float, default=0.8,
+                        help='fraction of examples that should succeed at once (default: 0.8)')
+    parser.add_argument('--period', type=float, default=0.5,
+                        help='presentation plus rest time in seconds (default: 0.5)')
+    parser.add_argument('--mnist-path', default='./mnist/', help='location of the MNIST data')
+    parser.add_argument('--output', default='./activity/intensityPredictor.npz', help='predictor file')
+    args = parser.parse_args()
+
+    dataset_name = 'testing' if args.testing else 'training'
+    data = get_labeled_data(args.mnist_path + dataset_name, bTrain = not args.testing, MNIST_data_path = args.mnist_path)
+    # histories of runs with --first-example are named by their range
+    run_range = re.search(r'(\d+)-\d+\.npy$', args.history)
+    if run_range is not None and int(run_range.group(1)) != args.first_example:
+        raise ValueError(args.history + ' starts at example ' + run_range.group(1)
+                         + ', pass --first-example ' + run_range.group(1))
+    retry_counts = np.load(args.history)
+    images = data['x'][(args.first_example + np.arange(len(retry_counts))) % len(data['x'])]
+    predictor = IntensityPredictor.fit(images, retry_counts, args.intensity, args.bins, args.coverage)
+    remaining = predictor.remaining_retries(images, retry_counts)
+    print('ink bins:', len(predictor.steps), 'intensity steps:', predictor.steps)
+    print('retry rate of the history:', retry_counts.mean(), 'with the predictor:', remaining.mean())
+    print('simulated time saved on the history:', (retry_counts.sum() - remaining.sum()) * args.period, 's')
+    predictor.save(args.output)
@@ -0,0 +1,104 @@
+'''
+The network model of Diehl & Cook (2015): the equations of the neurons and
+of the STDP of the input connections, with their parameters.
+
+The main script and functions/precision.py both build their networks from
+this module. The equations name the parameters rather than holding their
+values, so Brian2 resolves them when the network runs: the main script
+imports them as globals, which it can override from the command line,
+while other users pass get_namespace() to their groups and synapses.
+'''
+
+import numpy as np
+import brian2 as b2
+
+v_rest_e = -65. * b2.mV
+v_rest_i = -60. * b2.mV
+v_reset_e = -65. * b2.mV
+v_reset_i = -45. * b2.mV
+v_thresh_e = -52. * b2.mV
+v_thresh_i = -40. * b2.mV
+refrac_e = 5. * b2.ms
+refrac_i = 2. * b2.ms
+offset = 20.0 * b2.mV
+
+weight_ee_input = 78.
+delay_ee_input = (0*b2.ms, 10*b2.ms)
+delay_ei_input = (0*b2.ms, 5*b2.ms)
+
+tc_pre_ee = 20*b2.ms
+tc_post_1_ee = 20*b2.ms
+tc_post_2_ee = 40*b2.ms
+nu_ee_pre = 0.0001      # learning rate
+nu_ee_post = 0.01       # learning rate
+wmax_ee = 1.0
+tc_theta = 1e7 * b2.ms
+theta_plus_e = 0.05 * b2.mV
+
+# names of the parameters the equations below refer to
+PARAMETER_NAMES = ('v_rest_e', 'v_rest_i', 'v_reset_e', 'v_reset_i', 'v_thresh_e', 'v_thresh_i', 'refrac_e',
+                   'refrac_i', 'offset', 'tc_pre_ee', 'tc_post_1_ee', 'tc_post_2_ee', 'nu_ee_pre', 'nu_ee_post',
+                   'wmax_ee', 'tc_theta', 'theta_plus_e')
+
+# theta decays by theta * dt / tc_theta = 1e-8 of its value per step and timer
+# grows by 1e-5 s per step, both below the resolution of float32
+high_precision_dtypes = {'theta': np.float64, 'timer': np.float64}
+
+# timer grows by 0.1*dt per step and meets refrac_e at a step boundary; half
+# an increment of margin keeps the step it passes from depending on rounding,
+# which differs between float32 and float64
+v_thresh_e_str = '(v>(theta - offset + v_thresh_e)) and (timer>refrac_e + 0.05*dt)'
+v_thresh_i_str = 'v>v_thresh_i'
+v_reset_i_str = 'v=v_reset_i'
+
+neuron_eqs_i = '''
+        dv/dt = ((v_rest_i - v) + (I_synE+I_synI) / nS) / (10*ms)  : volt (unless refractory)
+        I_synE = ge * nS *         -v                           : amp
+        I_synI = gi * nS * (-85.*mV-v)                          : amp
+        dge/dt = -ge/(1.0*ms)                                   : 1
+        dgi/dt = -gi/(2.0*ms)                                  : 1
+        '''
+eqs_stdp_ee = '''
+                post2before                            : 1
+                dpre/dt   =   -pre/(tc_pre_ee)         : 1 (event-driven)
+                dpost1/dt  = -post1/(tc_post_1_ee)     : 1 (event-driven)
+                dpost2/dt  = -post2/(tc_post_2_ee)     : 1 (event-driven)
+            '''
+eqs_stdp_pre_ee = 'pre = 1.; w = clip(w + nu_ee_pre * post1, 0, wmax_ee)'
+eqs_stdp_post_ee = 'post2before = post2; w = clip(w + nu_ee_post * pre * post2before, 0, wmax_ee); post1 = 1.; post2 = 1.'
+
+
+def get_neuron_eqs_e(test_mode):
+    """ Equations of the excitatory neurons; theta is fixed in test mode
+        and adapts during training.
+    """
+    neuron_eqs_e = '''
+        dv/dt = ((v_rest_e - v) + (I_synE+I_synI) / nS) / (100*ms)  : volt (unless refractory)
+        I_synE = ge * nS *         -v                           : amp
+        I_synI = gi * nS * (-100.*mV-v)                          : amp
+        dge/dt = -ge/(1.0*ms)                                   : 1
+        dgi/dt = -gi/(2.0*ms)                                  : 1
+        '''
+    if test_mode:
+        neuron_eqs_e += '\n  theta      :volt'
+    else:
+        neuron_eqs_e += '\n  dtheta/dt = -theta / (tc_theta)  : volt'
+    neuron_eqs_e += '\n  dtimer/dt = 0.1  : second'
+    return neuron_eqs_e
+
+
+def get_reset_e(test_mode):
+    """ Reset of the excitatory neurons; it raises theta only in training.
+    """
+    if test_mode:
+        return 'v = v_reset_e; timer = 0*ms'
+    return 'v = v_reset_e; theta += theta_plus_e; timer = 0*ms'
+
+
+def get_namespace(**overrides):
+    """ The parameters by name, for the namespace argument of groups and
+        synapses, with the values of overrides in place of the defaults.
+    """
+    namespace = {name: globals()[name] for name in PARAMETER_NAMES}
+    namespace.update(overrides)
+    return namespace
@@ -0,0 +1,118 @@
+'''
+Parallel evaluation of a trained network over shards of the test set.
+
+In test mode the weights and theta are fixed, so the examples can be split
+into contiguous shards that are presented by separate processes. Every
+shard runs the main script in its own process, which builds the network
+once from weights/ and presents the examples of its shard with a seed
+derived from the shard's range, so a shard gives the same result whatever
+the number of workers. Each shard works in its own directory,
+activity/shard<first>-<end>/, where the main script also writes the files
+it names relative to the working directory, e.g. the weight plots of
+plot_2d_input_weights. The partial results are then merged, in order, into
+the files a single run writes to activity/.
+'''
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+MAIN_SCRIPT = 'Diehl&Cook_spiking_MNIST_Brian2.py'
+# every worker runs single-threaded, the pool provides the parallelism
+WORKER_ENV = {'OMP_NUM_THREADS': '1', 'OPENBLAS_NUM_THREADS': '1', 'MKL_NUM_THREADS': '1', 'MPLBACKEND': 'Agg'}
+RESULT_FILES = ('resultPopVecs', 'inputNumbers', 'retryCounts')
+
+
+def shard_ranges(num_examples, num_shards):
+    """ Split the examples 0..num_examples-1 into num_shards contiguous
+        ranges of nearly equal size and return them as (first, end) pairs.
+    """
+    bounds = np.linspace(0, num_examples, num_shards + 1).round().astype(int)
+    return [(int(first), int(end)) for first, end in zip(bounds[:-1], bounds[1:]) if end > first]
+
+
+def shard_seed(seed, first, end):
+    """ Return the seed of the shard first..end-1 of a run with seed.
+    """
+    return int(np.random.SeedSequence([seed, first, end]).generate_state(1)[0])
+
+
+def run_script(script_args, log_file, script_path='./', cwd=None):
+    """ Run the main script, in directory script_path, with script_args in
+        a new process and write its output to log_file. The process works
+        in cwd, by default script_path. Raises RuntimeError if it fails.
+    """
+    env = dict(os.environ, **WORKER_ENV)
+    with open(log_file, mode='w') as log:
+        process = subprocess.run([sys.executable, os.path.abspath(os.path.join(script_path, MAIN_SCRIPT))]
+                                 + list(script_args), cwd=cwd or script_path,
+                                 stdout=log, stderr=subprocess.STDOUT, env=env)
+    if process.returncode != 0:
+        raise RuntimeError('{} {} failed, see {}'.format(MAIN_SCRIPT, ' '.join(script_args), log_file))
+
+
+def run_shard(first, end, seed, data_path='./', script_args=(), mnist_path=None):
+    """ Present the test examples first..end-1 in a new process, working in
+        activity/shard<first>-<end>/. The results are written to
+        activity/<file><first>-<end>.npy. mnist_path defaults to
+        data_path/mnist/.
+    """
+    shard_path = os.path.join(data_path, 'activity', 'shard{}-{}'.format(first, end))
+    os.makedirs(shard_path, exist_ok=True)
+    mnist_path = mnist_path or os.path.join(data_path, 'mnist')
+    run_script(['--test', '--first-example', str(first), '--num-examples', str(end - first),
+                '--seed', str(shard_seed(seed, first, end)), '--data-path', os.path.abspath(data_path) + '/',
+                '--mnist-path', os.path.abspath(mnist_path) + '/'] + list(script_args),
+               shard_path + '.log', data_path, shard_path)
+
+
+def merge_shards(ranges, data_path='./', remove=True):
+    """ Concatenate the results of the shards in ranges, in order, and save
+        them as the results of a single run, activity/<file><N>.npy. Returns
+        the merged arrays by file name.
+    """
+    activity_path = os.path.join(data_path, 'activity')
+    num_examples = sum(end - first for first, end in ranges)
+    merged = {}
+    for name in RESULT_FILES:
+        shard_files = [os.path.join(activity_path, '{}{}-{}.npy'.format(name, first, end)) for first, end in ranges]
+        merged[name] = np.concatenate([np.load(f) for f in shard_files])
+        np.save(os.path.join(activity_path, name + str(num_examples)), merged[name])
+        if remove:
+            for f in shard_files:
+                os.remove(f)
+    return merged
+
+
+def run_parallel(num_examples, workers, num_shards=None, seed=0, data_path='./', script_args=(), mnist_path=None):
+    """ Present num_examples test examples in num_shards shards (default: one
+        per worker) on a pool of workers processes and merge the results.
+    """
+    ranges = shard_ranges(num_examples, num_shards or workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # list() re-raises the first error of a shard
+        list(pool.map(lambda r: run_shard(r[0], r[1], seed, data_path, script_args, mnist_path), ranges))
+    return merge_shards(ranges, data_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Test a trained network on several processes.')
+    parser.add_argument('--num-examples', type=int, default=10000, help='number of examples (default: 10000)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes (default: number of cores)')
+    parser.add_argument('--shards', type=int, default=None, help='number of shards (default: one per worker)')
+    parser.add_argument('--seed', type=int, default=0, help='seed the shard seeds are derived from (default: 0)')
+    parser.add_argument('--data-path', default='./', help='directory of the main script, with weights/ and activity/')
+    parser.add_argument('--mnist-path', default=None, help='location of the MNIST data (default: <data-path>/mnist/)')
+    args = parser.parse_args()
+
+    start = time.time()
+    merged = run_parallel(args.num_examples, args.workers, args.shards, args.seed, args.data_path,
+                          mnist_path=args.mnist_path)
+    elapsed = time.time() - start
+    print('time needed:', elapsed, 's,', args.num_examples / elapsed, 'examples per second on', args.workers, 'workers')
+    print('repeated presentations:', np.sum(merged['retryCounts']), 'retry rate:', np.mean(merged['retryCounts']))
@@ -0,0 +1,129 @@
+'''
+Benchmark and parity check of the single-precision mode.
+
+With float_precision = 'single' the main script stores the neuron state,
+the synaptic weights and the STDP traces in float32; theta and timer stay
+in float64. This script builds the training network of the main script
+for several sizes n_e in both precisions. It feeds both precisions the
+same input spike trains and reports:
+    - the memory of the state arrays of all groups and synapses,
+    - the wall-clock time per simulated time step,
+    - the spike counts of Ae per example in float32 against float64,
+      compared with compare_spike_counts of functions/inference.py, and
+      whether their mean per example differs by at most --tolerance.
+The network comes from functions/model.py, like the one of the main
+script. The two precisions diverge spike by spike, so parity holds in
+statistics.
+The accuracy is compared on trained networks by running the same sweep
+(functions/sweep.py) with --script-args='--precision single' and without,
+and comparing them with functions/rest.py.
+'''
+
+import time
+import argparse
+import numpy as np
+import brian2 as b2
+from brian2.core.variables import ArrayVariable
+
+from functions.data import get_labeled_data
+from functions.spikes import encode_poisson, example_rng
+from functions import model
+from functions.inference import N_INPUT, compare_spike_counts
+
+# weights of the connections between Ae and Ai, as in random/
+WEIGHT_EI = 10.4
+WEIGHT_IE = 17.0
+
+
+def build_network(n_e, dtype, seed=0):
+    """ Build the training network with n_e excitatory neurons in the given
+        float dtype, with random input weights. Returns the network and its
+        input and excitatory groups.
+    """
+    b2.prefs.core.default_float_dtype = dtype
+    rng = np.random.default_rng(seed)
+    namespace = model.get_namespace()
+    input_group = b2.SpikeGeneratorGroup(N_INPUT, [], [] * b2.second)
+    group_e = b2.NeuronGroup(n_e, model.get_neuron_eqs_e(False), threshold=model.v_thresh_e_str,
+                             refractory=model.refrac_e, reset=model.get_reset_e(False), method='euler',
+                             namespace=namespace, dtype=model.high_precision_dtypes)
+    group_i = b2.NeuronGroup(n_e, model.neuron_eqs_i, threshold=model.v_thresh_i_str, refractory=model.refrac_i,
+                             reset=model.v_reset_i_str, method='euler', namespace=namespace)
+    group_e.v = model.v_rest_e - 40. * b2.mV
+    group_i.v = model.v_rest_i - 40. * b2.mV
+    group_e.theta = 20. * b2.mV
+    input_conn = b2.Synapses(input_group, group_e, model='w : 1' + model.eqs_stdp_ee,
+                             on_pre='ge_post += w; ' + model.eqs_stdp_pre_ee, on_post=model.eqs_stdp_post_ee,
+                             namespace=namespace)
+    input_conn.connect(True)
+    w = rng.uniform(0, 0.3, (N_INPUT, n_e))
+    input_conn.w = (w * model.weight_ee_input / np.sum(w, axis=0)).reshape(-1)
+    min_delay, max_delay = model.delay_ee_input
+    input_conn.delay = min_delay + rng.uniform(0, 1, N_INPUT * n_e) * (max_delay - min_delay)
+    ei_conn = b2.Synapses(group_e, group_i, model='w : 1', on_pre='ge_post += w')
+    ei_conn.connect(j='i')
+    ei_conn.w = WEIGHT_EI
+    ie_conn = b2.Synapses(group_i, group_e, model='w : 1', on_pre='gi_post += w')
+    ie_conn.connect(condition='i != j')
+    ie_conn.w = WEIGHT_IE
+    counter = b2.SpikeMonitor(group_e, record=False)
+    net = b2.Network(input_group, group_e, group_i, input_conn, ei_conn, ie_conn, counter)
+    return net, input_group, counter
+
+
+def state_bytes(net):
+    """ Memory of the state arrays of all objects of a network, each counted once.
+    """
+    arrays = {}
+    for obj in net.objects:
+        for var in obj.variables.values():
+            if isinstance(var, ArrayVariable) and not var.constant:
+                arrays[id(var)] = var.get_value().nbytes
+    return sum(arrays.values())
+
+
+def run_examples(net, input_group, counter, images, intensity=4., example_time=0.35, resting_time=0.15, seed=0):
+    """ Present the images with the same spike trains for every network and
+        return the spike counts of Ae per example and the wall-clock time per
+        time step of the presentations.
+    """
+    dt = float(b2.defaultclock.dt)
+    num_steps = int(round(example_time / dt))
+    net.run(0 * b2.second)
+    spike_counts = []
+    elapsed = 0.
+    for example, image in enumerate(images):
+        indices, steps = encode_poisson(image.reshape(-1) / 8. * intensity, num_steps, dt, example_rng(seed, example))
+        input_group.set_spikes(indices, steps * b2.defaultclock.dt + net.t)
+        previous_count = np.array(counter.count[:])
+        start = time.time()
+        net.run(example_time * b2.second)
+        elapsed += time.time() - start
+        spike_counts.append(np.array(counter.count[:]) - previous_count)
+        net.run(resting_time * b2.second)
+    return np.array(spike_counts), elapsed / (num_steps * len(images))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the network in single and double precision.')
+    parser.add_argument('--n-e', type=int, nargs='+', default=[400, 1600, 6400],
+                        help='numbers of excitatory neurons (default: 400 1600 6400)')
+    parser.add_argument('--num-examples', type=int, default=10, help='training examples presented (default: 10)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the weights and spike trains (default: 0)')
+    parser.add_argument('--mnist-path', default='./mnist/', help='location of the MNIST data')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='largest accepted relative difference of the mean spikes per example (default: 0.1)')
+    args = parser.parse_args()
+
+    images = get_labeled_data(args.mnist_path + 'training', MNIST_data_path=args.mnist_path)['x'][:args.num_examples]
+    print('n_e    precision  state (MB)  step time (us)')
+    for n_e in args.n_e:
+        spike_counts = {}
+        for name, dtype in (('double', np.float64), ('single', np.float32)):
+            net, input_group, counter = build_network(n_e, dtype, args.seed)
+            spike_counts[name], step_time = run_examples(net, input_group, counter, images, seed=args.seed)
+            print('{:<6} {:<10} {:<11.1f} {:.1f}'.format(n_e, name, state_bytes(net) / 2.**20, step_time * 1e6))
+        statistics = compare_spike_counts(spike_counts['single'], spike_counts['double'])
+        print('parity at n_e = {}:'.format(n_e), ', '.join('{}: {:.4f}'.format(key, value)
+                                                            for key, value in statistics.items()))
+        print('within tolerance:', statistics['relative_difference'] <= args.tolerance)
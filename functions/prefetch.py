@@ -0,0 +1,58 @@
+'''
+A background producer that prepares simulation inputs ahead of time.
+'''
+
+import queue
+import threading
+
+
+class Prefetcher(object):
+    """ Call produce(key) for a sequence of keys in a background thread and
+        keep at most `depth` results ready for the consumer, so that input
+        preparation overlaps with the simulation of the current example.
+        produce: Function that prepares the input for one key.
+        keys: Iterable of keys, in the order they will be requested.
+        depth: Maximum number of results prepared ahead.
+    """
+
+    def __init__(self, produce, keys, depth):
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(produce, iter(keys)), daemon=True)
+        self._thread.start()
+
+    def _run(self, produce, keys):
+        try:
+            for key in keys:
+                if not self._put((key, produce(key), None)):
+                    return
+        except Exception as e:
+            self._put((None, None, e))
+            return
+        self._put((None, None, StopIteration()))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, key):
+        """ Return the prepared input for key. Keys must be requested in the
+            order they were given; errors raised by produce are re-raised here.
+        """
+        found_key, value, error = self._queue.get()
+        if error is not None:
+            raise error
+        if found_key != key:
+            raise ValueError('Prefetched input for {!r} but {!r} was requested'.format(found_key, key))
+        return value
+
+    def close(self):
+        """ Stop the producer thread and wait for it to finish.
+        """
+        self._stop.set()
+        self._thread.join()
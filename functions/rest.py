@@ -0,0 +1,119 @@
+'''
+Comparison of two sweeps that differ in their rest_mode, or in another
+option such as --precision.
+
+With rest_mode = 'decay' or 'reset' the main script replaces the simulated
+rest after every presentation by one vectorized update of the state. To
+check that this does not change what the network learns, run the same
+sweep (see functions/sweep.py) once per mode, e.g.
+
+    python -m functions.sweep --seeds 0 1 2 3 4 --output-path sweep_simulate/
+    python -m functions.sweep --seeds 0 1 2 3 4 --output-path sweep_decay/ --script-args='--rest-mode decay'
+
+and compare them with this script. The same check applies to the
+single-precision mode, with --script-args='--precision single'. The
+accuracies are tested for equivalence within --margin with two one-sided
+t-tests (TOST) on the accuracy differences of the runs with the same
+parameters and seed. The learned weights of each such pair of runs are
+compared by their mean, spread and Kolmogorov-Smirnov distance.
+'''
+
+import os
+import csv
+import argparse
+import numpy as np
+from scipy import stats
+
+from functions.connections import get_weights_file, load_dense_weights
+
+
+def read_results(sweep_path):
+    """ Return the rows of the results table of a sweep by run name, with
+        the numbers converted to float.
+    """
+    rows = {}
+    with open(os.path.join(sweep_path, 'results.csv'), newline='') as f:
+        for row in csv.DictReader(f):
+            rows[row['run']] = {key: (value if key == 'run' or value == '' else float(value))
+                                for key, value in row.items()}
+    return rows
+
+
+def compare_accuracy(accuracy, reference, margin):
+    """ Test whether the accuracies of the runs of two sweeps, paired by
+        run, are equivalent within margin, with two one-sided t-tests on
+        their differences (TOST): the p-value is the larger of the p-values
+        of the differences being above -margin and below margin, and
+        equivalence is shown when it is small. Returns a dict with the mean
+        of each sweep, the mean difference and the TOST p-value.
+    """
+    differences = np.asarray(accuracy) - np.asarray(reference)
+    mean_difference = np.mean(differences)
+    standard_error = np.std(differences, ddof=1) / np.sqrt(len(differences))
+    if standard_error == 0:
+        # every pair differs by the same amount, no test is needed
+        p_value = 0. if abs(mean_difference) < margin else 1.
+    else:
+        p_lower = stats.t.sf((mean_difference + margin) / standard_error, len(differences) - 1)
+        p_upper = stats.t.cdf((mean_difference - margin) / standard_error, len(differences) - 1)
+        p_value = max(p_lower, p_upper)
+    return {'mean_accuracy': np.mean(accuracy), 'reference_mean_accuracy': np.mean(reference),
+            'accuracy_difference': mean_difference, 'tost_p_value': p_value}
+
+
+def compare_weights(weights, reference):
+    """ Compare the weights learned by two runs. Returns a dict with the
+        relative difference of their mean and standard deviation and the
+        Kolmogorov-Smirnov distance of their distributions.
+    """
+    weights = np.asarray(weights).reshape(-1)
+    reference = np.asarray(reference).reshape(-1)
+    return {'relative_mean_difference': abs(weights.mean() - reference.mean()) / reference.mean(),
+            'relative_std_difference': abs(weights.std() - reference.std()) / reference.std(),
+            'ks_distance': stats.ks_2samp(weights, reference).statistic}
+
+
+def load_run_weights(run_path):
+    """ Load the trained XeAe weights of a run of a sweep.
+    """
+    return load_dense_weights(get_weights_file(os.path.join(run_path, 'weights', 'XeAe')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two sweeps that differ in their rest_mode or another option.')
+    parser.add_argument('sweep', help='output path of the sweep to check, e.g. sweep_decay/')
+    parser.add_argument('reference', help='output path of the reference sweep, e.g. sweep_simulate/')
+    parser.add_argument('--margin', type=float, default=0.02,
+                        help='largest accuracy difference still considered equivalent (default: 0.02)')
+    parser.add_argument('--alpha', type=float, default=0.05,
+                        help='significance level of the equivalence test (default: 0.05)')
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help='largest accepted relative difference of the mean and spread of the weights '
+                             '(default: 0.05)')
+    parser.add_argument('--max-ks', type=float, default=0.1,
+                        help='largest accepted Kolmogorov-Smirnov distance of the weights (default: 0.1)')
+    args = parser.parse_args()
+
+    results = read_results(args.sweep)
+    reference_results = read_results(args.reference)
+    runs = sorted(set(results) & set(reference_results))
+    print(len(runs), 'runs in both sweeps')
+
+    if len(runs) < 2:
+        raise ValueError('The equivalence test needs at least 2 runs in both sweeps')
+    statistics = compare_accuracy([results[run]['accuracy'] for run in runs],
+                                  [reference_results[run]['accuracy'] for run in runs], args.margin)
+    for key, value in statistics.items():
+        print(key + ':', value)
+    equivalent = statistics['tost_p_value'] < args.alpha
+
+    for run in runs:
+        weight_statistics = compare_weights(load_run_weights(os.path.join(args.sweep, run)),
+                                            load_run_weights(os.path.join(args.reference, run)))
+        print(run + ':', ', '.join('{}: {:.4f}'.format(key, value) for key, value in weight_statistics.items()))
+        equivalent &= max(weight_statistics['relative_mean_difference'],
+                          weight_statistics['relative_std_difference']) <= args.tolerance
+        equivalent &= weight_statistics['ks_distance'] <= args.max_ks
+    time_saved = np.mean([reference_results[run]['train_time'] - results[run]['train_time'] for run in runs])
+    print('training time saved per run:', time_saved, 's')
+    print('equivalent:', equivalent)
@@ -0,0 +1,139 @@
+'''
+Functions for pre-encoding MNIST examples as Poisson spike trains.
+
+A spike cache holds the input spikes of every example of a dataset for one
+seed and input intensity, in a CSR-style layout: 'indptr.npy' gives the
+range of spikes of each example in the raw uint16 blocks 'indices.bin'
+(input neuron) and 'steps.bin' (time step within the presentation).
+Example j is drawn from its own generator seeded with (seed, j), so a
+cached example and one encoded on the fly are identical.
+'''
+
+import os
+import json
+import argparse
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+def example_rng(seed, example):
+    """ Return the random generator used to encode one example.
+        seed: Seed of the spike cache.
+        example: Index of the example in its dataset.
+    """
+    return np.random.default_rng([seed, example])
+
+
+def encode_poisson(rates, num_steps, dt, rng):
+    """ Draw Poisson spike trains for one example, with the same statistics
+        as a PoissonGroup simulated for num_steps steps of length dt.
+        rates: Firing rate of each input neuron in Hz.
+        num_steps: Number of time steps of the presentation.
+        dt: Time step in seconds.
+        rng: numpy random Generator.
+        Returns (indices, steps) as uint16 arrays sorted by time step.
+    """
+    p = np.minimum(np.asarray(rates, dtype=np.float64) * dt, 1.)
+    counts = rng.binomial(num_steps, p)
+    neurons = np.repeat(np.arange(len(p), dtype=np.int64), counts)
+    steps = rng.integers(0, num_steps, len(neurons))
+    # A neuron spikes at most once per step: redraw collisions until the
+    # spike steps of every neuron are distinct.
+    while True:
+        order = np.lexsort((steps, neurons))
+        neurons, steps = neurons[order], steps[order]
+        duplicate = np.zeros(len(steps), dtype=bool)
+        duplicate[1:] = (neurons[1:] == neurons[:-1]) & (steps[1:] == steps[:-1])
+        if not duplicate.any():
+            break
+        steps[duplicate] = rng.integers(0, num_steps, np.count_nonzero(duplicate))
+    order = np.argsort(steps, kind='stable')
+    return neurons[order].astype(np.uint16), steps[order].astype(np.uint16)
+
+
+def spike_cache_name(data_path, dataset_name, seed, intensity):
+    """ Return the directory of the spike cache for a dataset, seed and
+        input intensity.
+    """
+    return os.path.join(data_path, 'spikes', '{}_seed{}_intensity{:g}'.format(
+        dataset_name, seed, intensity))
+
+
+def write_spike_cache(path, images, intensity, seed, num_steps, dt):
+    """ Encode every image of a dataset and write the spike cache.
+        path: Directory of the cache; it is created if needed.
+        images: uint8 array of shape (N, rows, cols), e.g. data['x'].
+        intensity: Input intensity; pixel p fires at p / 8 * intensity Hz.
+        seed: Seed of the cache.
+        num_steps: Number of time steps of one presentation.
+        dt: Time step in seconds.
+    """
+    if num_steps > np.iinfo(np.uint16).max + 1:
+        raise ValueError('A presentation of {} steps does not fit the uint16 step format'.format(num_steps))
+    os.makedirs(path, exist_ok=True)
+    N = len(images)
+    indptr = np.zeros(N + 1, dtype=np.int64)
+    with open(os.path.join(path, 'indices.bin'), mode='wb') as indices_file, \
+            open(os.path.join(path, 'steps.bin'), mode='wb') as steps_file:
+        for j in range(N):
+            rates = images[j].reshape(-1) / 8. * intensity
+            indices, steps = encode_poisson(rates, num_steps, dt, example_rng(seed, j))
+            indices_file.write(indices.tobytes())
+            steps_file.write(steps.tobytes())
+            indptr[j + 1] = indptr[j] + len(indices)
+    np.save(os.path.join(path, 'indptr.npy'), indptr)
+    meta = {'version': CACHE_VERSION, 'seed': seed, 'intensity': intensity,
+            'num_steps': num_steps, 'dt': dt, 'num_inputs': int(np.prod(images.shape[1:]))}
+    with open(os.path.join(path, 'meta.json'), mode='w') as f:
+        json.dump(meta, f)
+
+
+class SpikeTrainCache(object):
+    """ Read-only, memory-mapped view of a spike cache written by
+        write_spike_cache. cache[j] returns the (indices, steps) of example j.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != CACHE_VERSION:
+            raise ValueError('{} is not a version {} spike cache'.format(path, CACHE_VERSION))
+        self.indptr = np.load(os.path.join(path, 'indptr.npy'), mmap_mode='r')
+        num_spikes = int(self.indptr[-1])
+        self.indices = self._map(os.path.join(path, 'indices.bin'), num_spikes)
+        self.steps = self._map(os.path.join(path, 'steps.bin'), num_spikes)
+
+    @staticmethod
+    def _map(filename, num_spikes):
+        if num_spikes == 0:
+            return np.zeros(0, dtype=np.uint16)
+        return np.memmap(filename, dtype=np.uint16, mode='r', shape=(num_spikes,))
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, j):
+        start, stop = self.indptr[j], self.indptr[j + 1]
+        return self.indices[start:stop], self.steps[start:stop]
+
+
+if __name__ == '__main__':
+    from functions.data import get_labeled_data
+
+    parser = argparse.ArgumentParser(description='Pre-encode MNIST examples as Poisson spike trains.')
+    parser.add_argument('--testing', action='store_true', help='encode the test set instead of the training set')
+    parser.add_argument('--intensity', type=float, default=4., help='input intensity (default: 4)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the spike cache (default: 0)')
+    parser.add_argument('--example-time', type=float, default=0.35, help='presentation time in seconds (default: 0.35)')
+    parser.add_argument('--dt', type=float, default=0.1e-3, help='simulation time step in seconds (default: 0.1e-3)')
+    parser.add_argument('--mnist-path', default='./mnist/', help='location of the MNIST data')
+    parser.add_argument('--data-path', default='./', help='directory that holds the spikes folder')
+    args = parser.parse_args()
+
+    dataset_name = 'testing' if args.testing else 'training'
+    data = get_labeled_data(args.mnist_path + dataset_name, bTrain = not args.testing, MNIST_data_path = args.mnist_path)
+    path = spike_cache_name(args.data_path, dataset_name, args.seed, args.intensity)
+    print('encode', len(data['x']), dataset_name, 'examples to', path)
+    write_spike_cache(path, data['x'], args.intensity, args.seed,
+                      int(round(args.example_time / args.dt)), args.dt)
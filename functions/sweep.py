@@ -0,0 +1,182 @@
+'''
+Hyperparameter and seed sweeps over a pool of processes.
+
+Every configuration of a parameter grid is trained, labelled and tested
+with each seed by the main script in its own run directory, so runs never
+share weights, activity or checkpoints. A run first trains a network on
+the training set, then presents training examples in test mode to assign
+a class to every neuron, and finally presents the test set. A pool of
+processes works through the runs. Each run works in its own directory,
+where the main script also writes the files it names relative to the
+working directory, e.g. the weight plots of plot_2d_input_weights. All
+runs use the same compiled code cache, which Brian2 keeps per user, and
+read the same memory-mapped MNIST store. The accuracy, retry rate and
+time of every phase are appended to one results table as the runs finish.
+'''
+
+import os
+import csv
+import shlex
+import time
+import argparse
+import itertools
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from functions.parallel import run_script
+
+# parameters of the main script a sweep can vary, with their options
+PARAMETERS = ('input_intensity', 'nu_ee_pre', 'nu_ee_post', 'theta_plus_e', 'tc_theta', 'weight_ee_input')
+RESULT_COLUMNS = ('run', 'seed') + PARAMETERS + \
+                 ('accuracy', 'train_retry_rate', 'test_retry_rate', 'train_time', 'assign_time', 'test_time')
+
+
+def get_runs(grid, seeds):
+    """ Return every combination of the parameter values in grid, a dict of
+        lists by parameter name, with every seed as a list of dicts.
+    """
+    names = [name for name in PARAMETERS if name in grid]
+    runs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        for seed in seeds:
+            run = dict(zip(names, values))
+            run['run'] = 'run{:04d}'.format(len(runs))
+            run['seed'] = seed
+            runs.append(run)
+    return runs
+
+
+def get_assignments(result_monitor, input_numbers):
+    """ Assign every neuron the class it responded to most on average, or -1
+        if it never spiked, as get_new_assignments of the main script.
+    """
+    input_numbers = np.asarray(input_numbers)
+    rates = np.zeros((10, result_monitor.shape[1]))
+    for number in range(10):
+        if np.any(input_numbers == number):
+            rates[number] = np.mean(result_monitor[input_numbers == number], axis=0)
+    assignments = np.argmax(rates, axis=0)
+    assignments[np.max(rates, axis=0) == 0] = -1
+    return assignments
+
+
+def get_accuracy(assignments, result_monitor, input_numbers):
+    """ Fraction of the examples whose class with the highest mean rate of
+        its assigned neurons, as in get_recognized_number_ranking, is the label.
+    """
+    summed_rates = np.zeros((len(result_monitor), 10))
+    for number in range(10):
+        if np.any(assignments == number):
+            summed_rates[:, number] = np.mean(result_monitor[:, assignments == number], axis=1)
+    recognized = np.argsort(summed_rates, axis=1)[:, ::-1][:, 0]
+    return np.mean(recognized == np.asarray(input_numbers))
+
+
+def prepare_run_path(run_path, data_path):
+    """ Create the directories of a run; random/ links to the one in data_path.
+    """
+    for directory in ('weights', 'activity', 'checkpoints'):
+        os.makedirs(os.path.join(run_path, directory), exist_ok=True)
+    random_path = os.path.join(run_path, 'random')
+    if not os.path.exists(random_path):
+        os.symlink(os.path.abspath(os.path.join(data_path, 'random')), random_path)
+
+
+def run_config(run, output_path, num_train, num_assign, num_test, data_path='./', mnist_path='./mnist/',
+               script_args=(), script_path='./'):
+    """ Train, label and test the network of one run of get_runs in
+        output_path/<run>/, which is also the working directory of the main
+        script in script_path, and return its row of the results table.
+        script_args are passed to every phase of the main script.
+    """
+    run_path = os.path.join(output_path, run['run'])
+    prepare_run_path(run_path, data_path)
+    activity_path = os.path.join(run_path, 'activity')
+    common_args = ['--seed', str(run['seed']), '--data-path', os.path.abspath(run_path) + '/',
+                   '--mnist-path', os.path.abspath(mnist_path) + '/'] + list(script_args)
+    for name in PARAMETERS:
+        if name in run:
+            common_args += ['--' + name.replace('_', '-'), repr(run[name])]
+    row = dict(run)
+
+    start = time.time()
+    run_script(['--num-examples', str(num_train)] + common_args, os.path.join(run_path, 'train.log'),
+               script_path, run_path)
+    row['train_time'] = time.time() - start
+    row['train_retry_rate'] = np.mean(np.load(os.path.join(activity_path, 'retryCounts{}.npy'.format(num_train))))
+
+    # the labelling run is named by its range, so it does not collide with the test run
+    start = time.time()
+    run_script(['--test', '--training-set', '--first-example', '0', '--num-examples', str(num_assign)] + common_args,
+               os.path.join(run_path, 'assign.log'), script_path, run_path)
+    row['assign_time'] = time.time() - start
+    assignments = get_assignments(np.load(os.path.join(activity_path, 'resultPopVecs0-{}.npy'.format(num_assign))),
+                                  np.load(os.path.join(activity_path, 'inputNumbers0-{}.npy'.format(num_assign))))
+
+    start = time.time()
+    run_script(['--test', '--num-examples', str(num_test)] + common_args, os.path.join(run_path, 'test.log'),
+               script_path, run_path)
+    row['test_time'] = time.time() - start
+    row['test_retry_rate'] = np.mean(np.load(os.path.join(activity_path, 'retryCounts{}.npy'.format(num_test))))
+    row['accuracy'] = get_accuracy(assignments,
+                                   np.load(os.path.join(activity_path, 'resultPopVecs{}.npy'.format(num_test))),
+                                   np.load(os.path.join(activity_path, 'inputNumbers{}.npy'.format(num_test))))
+    return row
+
+
+def run_sweep(runs, workers, output_path, num_train, num_assign, num_test, data_path='./', mnist_path='./mnist/',
+              script_args=()):
+    """ Run every run of get_runs on a pool of workers processes. The row of
+        each run is appended to output_path/results.csv as soon as it
+        finishes; a run that fails is reported and the others go on.
+        Returns the rows in the order of runs.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    table_file = os.path.join(output_path, 'results.csv')
+    lock = threading.Lock()
+    with open(table_file, mode='w', newline='') as f:
+        csv.DictWriter(f, RESULT_COLUMNS).writeheader()
+
+    def work(run):
+        try:
+            row = run_config(run, output_path, num_train, num_assign, num_test, data_path, mnist_path, script_args)
+        except RuntimeError as error:
+            print(error)
+            return None
+        with lock:
+            with open(table_file, mode='a', newline='') as f:
+                csv.DictWriter(f, RESULT_COLUMNS).writerow(row)
+            print('{} seed {}: accuracy {:.4f}'.format(row['run'], row['seed'], row['accuracy']))
+        return row
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(work, runs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train and test the network for a grid of parameters and seeds.')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0], help='seeds of every configuration (default: 0)')
+    for name in PARAMETERS:
+        parser.add_argument('--' + name.replace('_', '-'), type=float, nargs='+',
+                            help='values of ' + name + ' (default: the one of the main script)')
+    parser.add_argument('--train-examples', type=int, default=1000, help='training examples (default: 1000)')
+    parser.add_argument('--assign-examples', type=int, default=1000,
+                        help='training examples presented to assign the neurons (default: 1000)')
+    parser.add_argument('--test-examples', type=int, default=1000, help='test examples (default: 1000)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes (default: number of cores)')
+    parser.add_argument('--data-path', default='./', help='directory with random/ (default: ./)')
+    parser.add_argument('--mnist-path', default='./mnist/', help='location of the MNIST data (default: ./mnist/)')
+    parser.add_argument('--output-path', default='./sweep/', help='directory of the runs and results.csv')
+    parser.add_argument('--script-args', default='',
+                        help="further options of the main script for every run, e.g. '--rest-mode decay'")
+    args = parser.parse_args()
+
+    grid = {name: getattr(args, name) for name in PARAMETERS if getattr(args, name) is not None}
+    runs = get_runs(grid, args.seeds)
+    print(len(runs), 'runs on', args.workers, 'workers')
+    start = time.time()
+    rows = run_sweep(runs, args.workers, args.output_path, args.train_examples, args.assign_examples,
+                     args.test_examples, args.data_path, args.mnist_path, shlex.split(args.script_args))
+    print('time needed:', time.time() - start, 's,', sum(row is not None for row in rows), 'of', len(runs), 'runs finished')
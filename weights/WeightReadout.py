@@ -1,7 +1,11 @@
+import sys
 import numpy as np
 from pylab import *
 import matplotlib.cm as cm
 
+sys.path.append('..')
+from functions.connections import get_weights_file, load_weights
+
 ending = ''
 chosenCmap = cm.get_cmap('hot_r') #cm.get_cmap('gist_ncar')
 
@@ -53,12 +57,16 @@ n_input = 784
 n_e = 400
 
 for name in readoutnames:
-    readout = np.load(name + '.npy')
     if (name == 'XeAe' + ending):
         value_arr = np.nan * np.ones((n_input, n_e))
     else:
         value_arr = np.nan * np.ones((n_e, n_e))
-    connection_parameters = readout
+    readout = load_weights(get_weights_file(name), value_arr.shape)
+    if readout['i'] is None:
+        value_arr = readout['w'].astype(np.float64)
+        connection_parameters = []
+    else:
+        connection_parameters = zip(readout['i'], readout['j'], readout['w'])
     #                 print(connection_parameters)
     for conn in connection_parameters: 
     #                     print(conn)